@@ -0,0 +1,62 @@
+import argparse
+import time
+
+import torch
+
+from data.data_loader import BatchCollator, _collate_fn
+
+parser = argparse.ArgumentParser(description='Times collation of synthetic batches with and without the lean path.')
+parser.add_argument('--batch-size', default=32, type=int, help='Utterances per batch')
+parser.add_argument('--freq-size', default=161, type=int, help='Frequency bins of the spectrograms')
+parser.add_argument('--min-frames', default=200, type=int, help='Shortest utterance in frames')
+parser.add_argument('--max-frames', default=1600, type=int, help='Longest utterance in frames')
+parser.add_argument('--labels-per-second', default=15, type=int, help='Transcript length per 100 frames')
+parser.add_argument('--num-labels', default=29, type=int, help='Size of the label set')
+parser.add_argument('--num-batches', default=50, type=int, help='Number of distinct batches')
+parser.add_argument('--repeats', default=3, type=int, help='Passes over the batches')
+parser.add_argument('--num-buffers', default=4, type=int, help='Ring size of the reused buffers')
+
+
+def make_batches(args):
+    labels_map = dict((str(i), i) for i in range(args.num_labels))
+    batches = []
+    for _ in range(args.num_batches):
+        frames = torch.randint(args.min_frames, args.max_frames + 1, (args.batch_size,)).tolist()
+        batch = []
+        for num_frames in frames:
+            transcript = torch.randint(1, args.num_labels, (num_frames * args.labels_per_second // 100,))
+            batch.append((torch.randn(args.freq_size, num_frames), transcript))
+        batches.append(batch)
+    legacy = [[(spect, transcript.tolist(),
+                torch.nn.functional.one_hot(transcript, num_classes=args.num_labels), labels_map)
+               for spect, transcript in batch] for batch in batches]
+    return batches, legacy
+
+
+def time_collate(collate_fn, batches, repeats):
+    collate_fn(batches[0])
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for batch in batches:
+            collate_fn(batch)
+    return (time.perf_counter() - start) / (repeats * len(batches))
+
+
+def main():
+    args = parser.parse_args()
+    torch.manual_seed(0)
+    batches, legacy = make_batches(args)
+    results = [('_collate_fn', time_collate(_collate_fn, legacy, args.repeats)),
+               ('BatchCollator', time_collate(BatchCollator(), batches, args.repeats)),
+               ('BatchCollator, %d buffers' % args.num_buffers,
+                time_collate(BatchCollator(args.num_buffers), batches, args.repeats))]
+    if torch.cuda.is_available():
+        results.append(('BatchCollator, %d pinned buffers' % args.num_buffers,
+                        time_collate(BatchCollator(args.num_buffers, pin_memory=True), batches, args.repeats)))
+    baseline = results[0][1]
+    for name, seconds in results:
+        print('%-36s %8.2f ms/batch  %5.2fx' % (name, seconds * 1000, baseline / seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+import argparse
+import time
+
+import torch
+from torch import nn
+
+from models.rnnt_loss import rnnt_loss, simple_rnnt_loss, prune_ranges, pruned_rnnt_loss, pruned_loss_scales
+
+parser = argparse.ArgumentParser(description='Trains a joint network on one synthetic batch with the pruned RNN-T '
+                                             'loss and compares it with the full lattice loss.')
+parser.add_argument('--batch-size', default=10, type=int, help='Utterances per batch')
+parser.add_argument('--frames', default=400, type=int, help='Encoder frames of the longest utterance')
+parser.add_argument('--labels', default=80, type=int, help='Labels of the longest transcript')
+parser.add_argument('--hidden-size', default=250, type=int, help='Size of the joint inputs')
+parser.add_argument('--vocab-size', default=29, type=int, help='Size of the label set, blank included')
+parser.add_argument('--prune-range', default=5, type=int, help='Label positions kept per frame')
+parser.add_argument('--steps', default=200, type=int, help='Training steps on the batch')
+parser.add_argument('--warmup', default=50, type=int, help='Warm-up steps of the pruned loss')
+parser.add_argument('--cuda', dest='cuda', action='store_true', help='Run on the GPU and report peak memory')
+
+
+class Joint(nn.Module):
+    def __init__(self, hidden_size, vocab_size):
+        super(Joint, self).__init__()
+        self.encoder = nn.Linear(hidden_size, hidden_size)
+        self.decoder = nn.Linear(hidden_size, hidden_size, bias=False)
+        self.output = nn.Linear(hidden_size, vocab_size)
+        self.simple_encoder = nn.Linear(hidden_size, vocab_size)
+        self.simple_decoder = nn.Linear(hidden_size, vocab_size)
+
+    def joint(self, f, g):
+        return self.output(torch.tanh(f + g))
+
+    def full_loss(self, f, g, labels, act_lens, label_lens):
+        return rnnt_loss(self.joint(self.encoder(f).unsqueeze(2), self.decoder(g).unsqueeze(1)),
+                         labels, act_lens, label_lens)
+
+    def pruned_loss(self, f, g, labels, act_lens, label_lens, prune_range, step=None, warmup=0):
+        simple_loss, occupancy = simple_rnnt_loss(self.simple_encoder(f), self.simple_decoder(g), labels, act_lens,
+                                                  label_lens)
+        starts, prune_range = prune_ranges(occupancy, act_lens, label_lens, prune_range)
+        pruned_loss = pruned_rnnt_loss(self.joint, self.encoder(f), self.decoder(g), labels, act_lens, label_lens,
+                                       starts, prune_range)
+        simple_scale, pruned_scale = pruned_loss_scales(step, warmup)
+        return simple_scale * simple_loss + pruned_scale * pruned_loss, simple_loss, pruned_loss
+
+
+def measure(loss_fn, device):
+    # peak memory on CUDA, the tensors kept for backward otherwise
+    saved = {}
+
+    def pack(tensor):
+        saved[tensor.data_ptr()] = tensor.numel() * tensor.element_size()
+        return tensor
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        loss = loss_fn()
+    loss.backward()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        memory = torch.cuda.max_memory_allocated()
+    else:
+        memory = sum(saved.values())
+    return time.perf_counter() - start, memory / 2 ** 20
+
+
+def main():
+    args = parser.parse_args()
+    torch.manual_seed(0)
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    B, T, U = args.batch_size, args.frames, args.labels
+    act_lens = torch.randint(T // 2, T + 1, (B,), dtype=torch.int32)
+    label_lens = torch.randint(U // 2, U + 1, (B,), dtype=torch.int32)
+    act_lens[0], label_lens[0] = T, U
+    act_lens, label_lens = act_lens.to(device), label_lens.to(device)
+    labels = torch.randint(1, args.vocab_size, (B, U), dtype=torch.int32, device=device)
+    f = torch.randn(B, T, args.hidden_size, device=device, requires_grad=True)
+    g = torch.randn(B, U + 1, args.hidden_size, device=device, requires_grad=True)
+    batch = (f, g, labels, act_lens, label_lens)
+
+    model = Joint(args.hidden_size, args.vocab_size).to(device)
+    optimizer = torch.optim.Adam(list(model.parameters()) + [f, g], lr=1e-3)
+    print('step   full loss   simple loss   pruned loss')
+    for step in range(args.steps + 1):
+        optimizer.zero_grad()
+        loss, simple_loss, pruned_loss = model.pruned_loss(*batch, prune_range=args.prune_range, step=step,
+                                                           warmup=args.warmup)
+        if step % max(args.steps // 10, 1) == 0:
+            with torch.no_grad():
+                full_loss = model.full_loss(*batch)
+            print('%4d %11.2f %13.2f %13.2f' % (step, full_loss, simple_loss.item(), pruned_loss.item()))
+        loss.backward()
+        optimizer.step()
+
+    print('B=%d T=%d U=%d H=%d V=%d on %s, %s' % (B, T, U, args.hidden_size, args.vocab_size, device,
+                                                 'peak memory' if args.cuda else 'tensors saved for backward'))
+    for name, loss_fn in (('full lattice', lambda: model.full_loss(*batch)),
+                          ('pruned, range %d' % args.prune_range,
+                           lambda: model.pruned_loss(*batch, prune_range=args.prune_range)[0])):
+        measure(loss_fn, device)
+        seconds, memory = measure(loss_fn, device)
+        print('%-18s %9.2f ms/step %9.1f MB' % (name, seconds * 1000, memory))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import argparse
+import time
+
+import torch
+
+from models.rnnt_loss import rnnt_loss
+
+parser = argparse.ArgumentParser(description='Compares the builtin RNN-T loss with warp-transducer on synthetic batches.')
+parser.add_argument('--batch-size', default=10, type=int, help='Utterances per batch')
+parser.add_argument('--frames', default=300, type=int, help='Encoder frames of the longest utterance')
+parser.add_argument('--labels', default=60, type=int, help='Labels of the longest transcript')
+parser.add_argument('--vocab-size', default=29, type=int, help='Size of the label set, blank included')
+parser.add_argument('--repeats', default=5, type=int, help='Timed forward and backward passes')
+parser.add_argument('--cuda', dest='cuda', action='store_true', help='Run on the GPU and report peak memory')
+
+
+def make_batch(args, device):
+    act_lens = torch.randint(args.frames // 2, args.frames + 1, (args.batch_size,), dtype=torch.int32)
+    label_lens = torch.randint(args.labels // 2, args.labels + 1, (args.batch_size,), dtype=torch.int32)
+    act_lens[0], label_lens[0] = args.frames, args.labels
+    acts = torch.randn(args.batch_size, args.frames, args.labels + 1, args.vocab_size, device=device)
+    labels = torch.randint(1, args.vocab_size, (args.batch_size, args.labels), dtype=torch.int32)
+    return acts, labels.to(device), act_lens.to(device), label_lens.to(device)
+
+
+def reference_losses():
+    losses = []
+    try:
+        from warprnnt_pytorch import RNNTLoss
+        losses.append(('warp-transducer', RNNTLoss(reduction='none')))
+    except ImportError:
+        pass
+    try:
+        from torchaudio.functional import rnnt_loss as torchaudio_rnnt_loss
+        losses.append(('torchaudio', lambda *batch: torchaudio_rnnt_loss(*batch, blank=0, reduction='none')))
+    except ImportError:
+        pass
+    return losses
+
+
+def run(loss_fn, batch, acts, warp_cpu=False):
+    acts = acts.detach().requires_grad_()
+    inputs = torch.log_softmax(acts, dim=3) if warp_cpu else acts
+    costs = loss_fn(inputs, *batch)
+    costs.sum().backward()
+    return costs.detach(), acts.grad
+
+
+def time_loss(loss_fn, batch, acts, repeats, warp_cpu=False):
+    run(loss_fn, batch, acts, warp_cpu)
+    if acts.is_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        run(loss_fn, batch, acts, warp_cpu)
+    if acts.is_cuda:
+        torch.cuda.synchronize()
+    peak = torch.cuda.max_memory_allocated() / 2 ** 20 if acts.is_cuda else float('nan')
+    return (time.perf_counter() - start) / repeats, peak
+
+
+def main():
+    args = parser.parse_args()
+    torch.manual_seed(0)
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    acts, labels, act_lens, label_lens = make_batch(args, device)
+    batch = (labels, act_lens, label_lens)
+
+    def builtin(acts, *batch):
+        return rnnt_loss(acts, *batch, reduction='none')
+
+    costs, grads = run(builtin, batch, acts)
+    results = [('builtin',) + time_loss(builtin, batch, acts, args.repeats)]
+    for name, loss_fn in reference_losses():
+        warp_cpu = name == 'warp-transducer' and not args.cuda
+        reference_costs, reference_grads = run(loss_fn, batch, acts, warp_cpu)
+        print('%s: max cost difference %.2e, max gradient difference %.2e' % (
+            name, (costs - reference_costs).abs().max(), (grads - reference_grads).abs().max()))
+        results.append((name,) + time_loss(loss_fn, batch, acts, args.repeats, warp_cpu))
+
+    print('B=%d T=%d U=%d V=%d on %s, activations %.1f MB' % (
+        args.batch_size, args.frames, args.labels, args.vocab_size, device, acts.numel() * 4 / 2 ** 20))
+    for name, seconds, peak in results:
+        print('%-16s %9.2f ms/step  peak %8.1f MB' % (name, seconds * 1000, peak))
+
+
+if __name__ == '__main__':
+    main()
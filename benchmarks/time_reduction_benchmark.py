@@ -0,0 +1,68 @@
+import argparse
+import time
+
+import torch
+
+from models.models import Transducer
+
+parser = argparse.ArgumentParser(description='Times training steps of the Transducer at each encoder time reduction.')
+parser.add_argument('--batch-size', default=10, type=int, help='Utterances per batch')
+parser.add_argument('--frames', default=800, type=int, help='Spectrogram frames of the longest utterance')
+parser.add_argument('--labels', default=80, type=int, help='Labels of the longest transcript')
+parser.add_argument('--hidden-size', default=250, type=int, help='Hidden size of the RNN-T model')
+parser.add_argument('--encoder-num-layers', default=4, type=int, help='Encoder layers')
+parser.add_argument('--decoder-num-layers', default=2, type=int, help='Prediction network layers')
+parser.add_argument('--vocab-size', default=29, type=int, help='Size of the label set, blank included')
+parser.add_argument('--rates', default='1,2,4,8', help='Comma separated time reductions')
+parser.add_argument('--repeats', default=3, type=int, help='Timed training steps per rate')
+parser.add_argument('--conv-subsampling', dest='conv_subsampling', action='store_true',
+                    help='Subsample 4x with strided convolutions before the LSTMs')
+parser.add_argument('--cuda', dest='cuda', action='store_true', help='Run on the GPU')
+
+
+def main():
+    args = parser.parse_args()
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    torch.manual_seed(0)
+    B, T, U = args.batch_size, args.frames, args.labels
+    xlen = torch.randint(T // 2, T + 1, (B,), dtype=torch.int32)
+    ylen = torch.randint(U // 2, U + 1, (B,), dtype=torch.int32)
+    xlen[0], ylen[0] = T, U
+    xs = torch.randn(B, 1, 161, T, device=device)
+    ys = torch.randint(1, args.vocab_size, (B, U), device=device)
+
+    print('B=%d T=%d U=%d on %s%s' % (B, T, U, device, ', conv subsampling' if args.conv_subsampling else ''))
+    for rate in [int(rate) for rate in args.rates.split(',')]:
+        model = Transducer(input_size=161,
+                           vocab_size=args.vocab_size,
+                           hidden_size=args.hidden_size,
+                           decoder_num_layers=args.decoder_num_layers,
+                           encoder_num_layers=args.encoder_num_layers,
+                           dropout=0.2,
+                           bidirectional=True,
+                           loss='builtin',
+                           time_reduction=rate,
+                           conv_subsampling=args.conv_subsampling).to(device)
+        optimizer = torch.optim.SGD(model.parameters(), lr=1e-3, momentum=.9)
+
+        def step():
+            optimizer.zero_grad()
+            loss = model(xs, ys, xlen, ylen)
+            loss.backward()
+            optimizer.step()
+
+        step()
+        if args.cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            step()
+        if args.cuda:
+            torch.cuda.synchronize()
+        seconds = (time.perf_counter() - start) / args.repeats
+        print('time reduction %d: %4d encoder frames, %8.1f ms/step, %6.1f utterances/s' % (
+            rate, int(model.encoder.get_seq_lens(xlen).max()), seconds * 1000, B / seconds))
+
+
+if __name__ == '__main__':
+    main()
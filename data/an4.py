@@ -3,8 +3,14 @@ import os
 import io
 import shutil
 import tarfile
+from multiprocessing import Pool
+
+import numpy as np
 import wget
-from data.utils import create_manifest
+from tqdm import tqdm
+
+from data.audio_shards import write_pcm
+from data.utils import PrepJournal, write_manifest
 
 parser = argparse.ArgumentParser(description='Processes and downloads an4.')
 parser.add_argument('--target-dir', default='an4_dataset/', help='Path to save dataset')
@@ -12,51 +18,57 @@ parser.add_argument('--min-duration', default=1, type=int,
                     help='Prunes training samples shorter than the min duration (given in seconds, default 1)')
 parser.add_argument('--max-duration', default=15, type=int,
                     help='Prunes training samples longer than the max duration (given in seconds, default 15)')
-args = parser.parse_args()
+parser.add_argument('--num-workers', default=None, type=int,
+                    help='Processes converting audio, defaults to the number of cpus')
 
+SAMPLE_RATE = 16000
 
-def _format_data(root_path, data_tag, name, wav_folder):
-    data_path = args.target_dir + data_tag + '/' + name + '/'
-    new_transcript_path = data_path + '/txt/'
-    new_wav_path = data_path + '/wav/'
 
-    os.makedirs(new_transcript_path)
-    os.makedirs(new_wav_path)
+def _format_data(target_dir, root_path, data_tag, name, journal, num_workers=None):
+    data_path = os.path.join(target_dir, data_tag, name)
+    new_transcript_path = os.path.join(data_path, 'txt')
+    new_wav_path = os.path.join(data_path, 'wav')
+    os.makedirs(new_transcript_path, exist_ok=True)
+    os.makedirs(new_wav_path, exist_ok=True)
 
     wav_path = root_path + 'wav/'
     file_ids = root_path + 'etc/an4_%s.fileids' % data_tag
     transcripts = root_path + 'etc/an4_%s.transcription' % data_tag
-    train_path = wav_path + wav_folder
-
-    _convert_audio_to_wav(train_path)
-    _format_files(file_ids, new_transcript_path, new_wav_path, transcripts, wav_path)
-
-
-def _convert_audio_to_wav(train_path):
-    with os.popen('find %s -type f -name "*.raw"' % train_path) as pipe:
-        for line in pipe:
-            raw_path = line.strip()
-            new_path = line.replace('.raw', '.wav').strip()
-            cmd = 'sox -t raw -r %d -b 16 -e signed-integer -B -c 1 \"%s\" \"%s\"' % (
-                16000, raw_path, new_path)
-            os.system(cmd)
-
-
-def _format_files(file_ids, new_transcript_path, new_wav_path, transcripts, wav_path):
     with open(file_ids, 'r') as f:
-        with open(transcripts, 'r') as t:
-            paths = f.readlines()
-            transcripts = t.readlines()
-            for x in range(len(paths)):
-                path = wav_path + paths[x].strip() + '.wav'
-                filename = path.split('/')[-1]
-                extracted_transcript = _process_transcript(transcripts, x)
-                current_path = os.path.abspath(path)
-                new_path = new_wav_path + filename
-                text_path = new_transcript_path + filename.replace('.wav', '.txt')
-                with io.FileIO(text_path, "w") as file:
-                    file.write(extracted_transcript.encode('utf-8'))
-                os.rename(current_path, new_path)
+        paths = [line.strip() for line in f if line.strip()]
+    with open(transcripts, 'r') as t:
+        transcripts = t.readlines()
+
+    jobs = []
+    for x, path in enumerate(paths):
+        key = data_tag + ':' + path
+        if key in journal:
+            continue
+        filename = os.path.basename(path)
+        jobs.append((key, wav_path + path + '.raw',
+                     os.path.join(new_wav_path, filename + '.wav'),
+                     os.path.join(new_transcript_path, filename + '.txt'),
+                     _process_transcript(transcripts, x)))
+    _write_transcripts(jobs)
+    with Pool(num_workers) as pool:
+        for key, rows in tqdm(pool.imap_unordered(_convert_audio_to_wav, jobs, chunksize=16), total=len(jobs)):
+            journal.add(key, rows)
+
+
+def _convert_audio_to_wav(job):
+    """
+    Converts a headerless 16 kHz big endian 16 bit raw recording to wav.
+    """
+    key, raw_path, new_path, text_path, _ = job
+    pcm = np.fromfile(raw_path, dtype='>i2')
+    write_pcm(new_path, pcm, SAMPLE_RATE)
+    return key, [(os.path.abspath(new_path), os.path.abspath(text_path), len(pcm) / float(SAMPLE_RATE), len(pcm))]
+
+
+def _write_transcripts(jobs):
+    for _, _, _, text_path, extracted_transcript in jobs:
+        with io.FileIO(text_path, "w") as file:
+            file.write(extracted_transcript.encode('utf-8'))
 
 
 def _process_transcript(transcripts, x):
@@ -65,21 +77,28 @@ def _process_transcript(transcripts, x):
 
 
 def main():
+    args = parser.parse_args()
     root_path = 'an4/'
     name = 'an4'
-    wget.download('http://www.speech.cs.cmu.edu/databases/an4/an4_raw.bigendian.tar.gz')
-    tar = tarfile.open('an4_raw.bigendian.tar.gz')
-    tar.extractall()
-    os.makedirs(args.target_dir)
-    _format_data(root_path, 'train', name, 'an4_clstk')
-    _format_data(root_path, 'test', name, 'an4test_clstk')
-    shutil.rmtree(root_path)
-    os.remove('an4_raw.bigendian.tar.gz')
-    train_path = args.target_dir + '/train/'
-    test_path = args.target_dir + '/test/'
-    print ('\n', 'Creating manifests...')
-    create_manifest(train_path, 'an4_train_manifest.csv', args.min_duration, args.max_duration)
-    create_manifest(test_path, 'an4_val_manifest.csv')
+    archive = 'an4_raw.bigendian.tar.gz'
+    os.makedirs(args.target_dir, exist_ok=True)
+    journal = PrepJournal(os.path.join(args.target_dir, '.prep_journal.jsonl'))
+    if 'archive:' + archive not in journal:
+        if 'extracted:' + archive not in journal:
+            if not os.path.exists(archive):
+                wget.download('http://www.speech.cs.cmu.edu/databases/an4/an4_raw.bigendian.tar.gz')
+            tar = tarfile.open(archive)
+            tar.extractall()
+            tar.close()
+            journal.add('extracted:' + archive)
+        _format_data(args.target_dir, root_path, 'train', name, journal, args.num_workers)
+        _format_data(args.target_dir, root_path, 'test', name, journal, args.num_workers)
+        journal.add('archive:' + archive)
+        shutil.rmtree(root_path)
+        os.remove(archive)
+    print('\n', 'Creating manifests...')
+    write_manifest(journal.rows('train:'), 'an4_train_manifest.csv', args.min_duration, args.max_duration)
+    write_manifest(journal.rows('test:'), 'an4_val_manifest.csv')
 
 
 if __name__ == '__main__':
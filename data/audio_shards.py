@@ -0,0 +1,170 @@
+import argparse
+import json
+import os
+import wave
+
+import numpy as np
+from tqdm import tqdm
+
+parser = argparse.ArgumentParser(description='Packs the utterances of a manifest into sharded PCM containers.')
+parser.add_argument('--manifest', metavar='DIR', help='path to manifest csv', required=True)
+parser.add_argument('--output-dir', default='packed_dataset/', help='Directory to store the shards')
+parser.add_argument('--sample-rate', default=16000, type=int, help='Sample rate of the audio files')
+parser.add_argument('--utterances-per-shard', default=4096, type=int, help='Number of utterances in a shard')
+
+SHARD_NAME = 'shard-%05d.pcm'
+# columns of index.npy
+SHARD, PCM_OFFSET, NUM_SAMPLES, TEXT_OFFSET, TEXT_LENGTH = range(5)
+
+
+def load_transcript(entry):
+    """
+    Manifests hold either the path of a transcript file or the transcript itself in their second column.
+    """
+    entry = entry.strip()
+    if os.path.isfile(entry):
+        with open(entry, encoding='utf-8') as f:
+            return f.read().strip()
+    return entry
+
+
+def read_pcm(path, sample_rate):
+    """
+    Reads a 16 bit PCM wav file without converting it to float. Multi channel files are averaged.
+    """
+    with wave.open(path, 'rb') as f:
+        if f.getsampwidth() != 2:
+            raise ValueError("{} is not 16 bit PCM".format(path))
+        if f.getframerate() != sample_rate:
+            raise ValueError("{} is sampled at {} Hz, expected {}".format(path, f.getframerate(), sample_rate))
+        channels = f.getnchannels()
+        pcm = np.frombuffer(f.readframes(f.getnframes()), dtype='<i2')
+    if channels > 1:
+        pcm = pcm.reshape(-1, channels).mean(axis=1).astype('<i2')
+    return pcm
+
+
+def write_pcm(path, pcm, sample_rate):
+    """
+    Writes int16 samples as a mono 16 bit PCM wav file. The file is written under a temporary name and renamed, so
+    an interrupted write never leaves a truncated file at path.
+    """
+    tmp_path = path + '.tmp'
+    with wave.open(tmp_path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(np.ascontiguousarray(pcm, dtype='<i2').tobytes())
+    os.replace(tmp_path, path)
+
+
+def pcm_to_float(pcm):
+    return pcm.astype(np.float32) / 32768
+
+
+def pack_manifest(manifest_filepath, output_dir, sample_rate=16000, utterances_per_shard=4096):
+    """
+    Converts a manifest into shard files. A shard holds the int16 PCM and the utf-8 transcript of consecutive
+    manifest rows back to back, so the (duration ordered) rows of a batch are read with one sequential read.
+    index.npy keeps (shard, pcm offset, samples, text offset, text length) for every row and meta.json the sample
+    rate and durations.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    with open(manifest_filepath) as f:
+        ids = [x.strip().split(',') for x in f if x.strip()]
+
+    index = np.zeros((len(ids), 5), dtype=np.int64)
+    durations = np.zeros(len(ids), dtype=np.float32)
+    shard_file = None
+    for i, sample in enumerate(tqdm(ids, total=len(ids))):
+        if i % utterances_per_shard == 0:
+            if shard_file is not None:
+                shard_file.close()
+            shard_id = i // utterances_per_shard
+            shard_file = open(os.path.join(output_dir, SHARD_NAME % shard_id), 'wb')
+            offset = 0
+        pcm = read_pcm(sample[0], sample_rate)
+        text = load_transcript(sample[1]).encode('utf-8')
+        shard_file.write(pcm.tobytes())
+        # keep the next record 2 byte aligned so PCM can be viewed as int16 in place
+        shard_file.write(text + b'\0' * (len(text) % 2))
+        index[i] = (shard_id, offset, len(pcm), offset + pcm.nbytes, len(text))
+        durations[i] = len(pcm) / float(sample_rate)
+        offset += pcm.nbytes + len(text) + len(text) % 2
+    if shard_file is not None:
+        shard_file.close()
+
+    np.save(os.path.join(output_dir, 'index.npy'), index)
+    np.save(os.path.join(output_dir, 'durations.npy'), durations)
+    meta = dict(manifest=os.path.abspath(manifest_filepath),
+                sample_rate=sample_rate,
+                num_utterances=len(ids),
+                num_shards=int(index[-1, SHARD]) + 1 if len(ids) else 0)
+    with open(os.path.join(output_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+
+class AudioShards(object):
+    def __init__(self, path):
+        """
+        Reader of the shards written by `pack_manifest`. Random access returns int16 views of memory-mapped shards,
+        `iter_shard` streams a whole shard with a single sequential read.
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.path = path
+        self.sample_rate = self.meta['sample_rate']
+        self.index = np.load(os.path.join(path, 'index.npy'), mmap_mode='r')
+        self.durations = np.load(os.path.join(path, 'durations.npy'), mmap_mode='r')
+        self.shards = None
+
+    def _shard(self, shard_id):
+        if self.shards is None:
+            self.shards = {}
+        if shard_id not in self.shards:
+            self.shards[shard_id] = np.memmap(os.path.join(self.path, SHARD_NAME % shard_id), dtype=np.uint8,
+                                              mode='r')
+        return self.shards[shard_id]
+
+    def __getitem__(self, index):
+        """
+        :return: PCM as an int16 array and the transcript
+        """
+        row = self.index[index]
+        shard = self._shard(int(row[SHARD]))
+        pcm = shard[row[PCM_OFFSET]:row[PCM_OFFSET] + 2 * row[NUM_SAMPLES]].view('<i2')
+        text = bytes(shard[row[TEXT_OFFSET]:row[TEXT_OFFSET] + row[TEXT_LENGTH]]).decode('utf-8')
+        return pcm, text
+
+    def iter_shard(self, shard_id):
+        rows = np.nonzero(self.index[:, SHARD] == shard_id)[0]
+        with open(os.path.join(self.path, SHARD_NAME % shard_id), 'rb') as f:
+            data = f.read()
+        for i in rows:
+            row = self.index[i]
+            pcm = np.frombuffer(data, dtype='<i2', count=int(row[NUM_SAMPLES]), offset=int(row[PCM_OFFSET]))
+            text = data[row[TEXT_OFFSET]:row[TEXT_OFFSET] + row[TEXT_LENGTH]].decode('utf-8')
+            yield int(i), pcm, text
+
+    def __iter__(self):
+        for shard_id in range(self.meta['num_shards']):
+            for sample in self.iter_shard(shard_id):
+                yield sample
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shards'] = None
+        return state
+
+
+def main():
+    args = parser.parse_args()
+    pack_manifest(args.manifest, args.output_dir, args.sample_rate, args.utterances_per_shard)
+    print('Shards saved to', args.output_dir)
+
+
+if __name__ == '__main__':
+    main()
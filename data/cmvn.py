@@ -0,0 +1,118 @@
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+from tqdm import tqdm
+
+parser = argparse.ArgumentParser(description='Computes global per frequency bin feature statistics of a manifest.')
+parser.add_argument('--manifest', metavar='DIR', help='path to manifest csv', required=True)
+parser.add_argument('--output', default='cmvn.npz', help='File to store the statistics')
+parser.add_argument('--sample-rate', default=16000, type=int, help='Sample rate')
+parser.add_argument('--window-size', default=.02, type=float, help='Window size for spectrogram in seconds')
+parser.add_argument('--window-stride', default=.01, type=float, help='Window stride for spectrogram in seconds')
+parser.add_argument('--window', default='hamming', help='Window type for spectrogram generation')
+parser.add_argument('--num-workers', default=4, type=int, help='Number of processes used for accumulation')
+
+
+class CMVNStats(object):
+    def __init__(self):
+        """
+        Running per frequency bin mean and sum of squared deviations of features (Welford). Accumulators of
+        disjoint parts of a dataset are combined exactly with `merge` (Chan et al.), so workers accumulate
+        independently and the results are reduced at the end.
+        """
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, spect):
+        """
+        :param spect: (freq, time) features of an utterance
+        """
+        spect = np.asarray(spect, dtype=np.float64)
+        mean = spect.mean(axis=1)
+        deviation = spect - mean[:, None]
+        self._merge(spect.shape[1], mean, np.einsum('ft,ft->f', deviation, deviation))
+
+    def merge(self, other):
+        self._merge(other.count, other.mean, other.m2)
+        return self
+
+    def _merge(self, count, mean, m2):
+        if count == 0:
+            return
+        if self.count == 0:
+            self.count, self.mean, self.m2 = count, mean.copy(), m2.copy()
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (count / float(total))
+        self.m2 = self.m2 + m2 + delta * delta * (self.count * float(count) / total)
+        self.count = total
+
+    @property
+    def variance(self):
+        return self.m2 / self.count
+
+    @property
+    def std(self):
+        return np.sqrt(np.maximum(self.variance, 1e-10))
+
+    def save(self, path):
+        np.savez(path, count=self.count, mean=self.mean, m2=self.m2)
+
+    @classmethod
+    def load(cls, path):
+        stats = cls()
+        with np.load(path) as f:
+            stats.count, stats.mean, stats.m2 = int(f['count']), f['mean'], f['m2']
+        return stats
+
+
+_worker_parser = None
+
+
+def _init_worker(audio_conf):
+    global _worker_parser
+    from data.data_loader import SpectrogramParser
+    _worker_parser = SpectrogramParser(audio_conf, normalize=False, augment=False)
+
+
+def _accumulate(audio_paths):
+    stats = CMVNStats()
+    for audio_path in audio_paths:
+        stats.update(_worker_parser.parse_audio(audio_path).numpy())
+    return stats, len(audio_paths)
+
+
+def compute_stats(manifest_filepath, audio_conf, num_workers=4, chunk_size=64):
+    """
+    Accumulates the statistics of the unnormalized spectrograms of a manifest in a single pass, in parallel over
+    chunks of utterances.
+    """
+    audio_conf = dict(audio_conf, noise_dir=None)
+    with open(manifest_filepath) as f:
+        audio_paths = [x.strip().split(',')[0] for x in f if x.strip()]
+    chunks = [audio_paths[i:i + chunk_size] for i in range(0, len(audio_paths), chunk_size)]
+    stats = CMVNStats()
+    with Pool(num_workers, initializer=_init_worker, initargs=(audio_conf,)) as pool, \
+            tqdm(total=len(audio_paths)) as progress:
+        for chunk_stats, num_utterances in pool.imap_unordered(_accumulate, chunks):
+            stats.merge(chunk_stats)
+            progress.update(num_utterances)
+    return stats
+
+
+def main():
+    args = parser.parse_args()
+    audio_conf = dict(sample_rate=args.sample_rate,
+                      window_size=args.window_size,
+                      window_stride=args.window_stride,
+                      window=args.window)
+    stats = compute_stats(args.manifest, audio_conf, args.num_workers)
+    stats.save(args.output)
+    print('Statistics of', stats.count, 'frames saved to', args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,9 @@
+import heapq
 import os
+import queue
 import subprocess
+import threading
+import time
 from tempfile import NamedTemporaryFile
 
 from torch.distributed import get_rank
@@ -19,36 +23,18 @@ import math
 from torch.utils.data import DataLoader
 from torch.utils.data import Dataset
 
+from data.audio_shards import AudioShards, load_transcript, pcm_to_float
+from data.feature_cache import FeatureCache
+from data.manifest_index import ManifestIndex, label_table, tokenize
+from data.noise_bank import NoiseBank, LENGTH
+from data.utils import get_audio_info
+
 # from data.SpecAugment import sparse_image_warp_zcaceres
 
 windows = {'hamming': scipy.signal.hamming, 'hann': scipy.signal.hann, 'blackman': scipy.signal.blackman,
            'bartlett': scipy.signal.bartlett}
 
 
-def mel_filter_bank(inpus):
-    low_freq_mel = 0
-    high_freq_mel = (2595 * numpy.log10(1 + (sample_rate / 2) / 700))  # Convert Hz to Mel
-    mel_points = numpy.linspace(low_freq_mel, high_freq_mel, nfilt + 2)  # Equally spaced in Mel scale
-    hz_points = (700 * (10 ** (mel_points / 2595) - 1))  # Convert Mel to Hz
-    bin = numpy.floor((NFFT + 1) * hz_points / sample_rate)
-
-    fbank = numpy.zeros((nfilt, int(numpy.floor(NFFT / 2 + 1))))
-    for m in range(1, nfilt + 1):
-        f_m_minus = int(bin[m - 1])  # left
-        f_m = int(bin[m])  # center
-        f_m_plus = int(bin[m + 1])  # right
-
-        for k in range(f_m_minus, f_m):
-            fbank[m - 1, k] = (k - bin[m - 1]) / (bin[m] - bin[m - 1])
-        for k in range(f_m, f_m_plus):
-            fbank[m - 1, k] = (bin[m + 1] - k) / (bin[m + 1] - bin[m])
-    filter_banks = numpy.dot(pow_frames, fbank.T)
-    filter_banks = numpy.where(filter_banks == 0, numpy.finfo(float).eps, filter_banks)  # Numerical Stability
-    filter_banks = 20 * numpy.log10(filter_banks)  # dB
-
-    return filter_banks
-
-
 def zero_pad_concat(inputs):
     max_t = max(len(inp) for inp in inputs)
     shape = (len(inputs), max_t) + inputs[0].shape[1:]
@@ -62,7 +48,7 @@ def end_pad_label(inputs):
     max_t = max(len(i) for i in inputs)
     # max_t = 50
     shape = (len(inputs), max_t)
-    labels = np.full(shape, fill_value=26, dtype='i')
+    labels = np.full(shape, fill_value=0, dtype='i')
     for e, l in enumerate(inputs):
         labels[e, :len(l)] = l
 
@@ -88,43 +74,44 @@ def end_pad_label(inputs):
 #     return warped_spectro.squeeze(3)
 
 
-def freq_mask(spec, F=15, num_masks=1, replace_with_zero=True):
-    cloned = spec.clone()
-    num_mel_channels = cloned.shape[1]
-
-    for i in range(0, num_masks):
-        f = random.randrange(0, F)
-        f_zero = random.randrange(0, num_mel_channels - f)
-
-        # avoids randrange error if values are equal and range is empty
-        if (f_zero == f_zero + f): return cloned
-
-        mask_end = random.randrange(f_zero, f_zero + f)
-        if (replace_with_zero):
-            cloned[0][f_zero:mask_end] = 0
-        else:
-            cloned[0][f_zero:mask_end] = cloned.mean()
-
-    return cloned
-
-
-def time_mask(spec, T=15, num_masks=1, replace_with_zero=True):
-    cloned = spec.clone()
-    len_spectro = cloned.shape[2]
-
-    for i in range(0, num_masks):
-        t = random.randrange(0, T)
-        t_zero = random.randrange(0, len_spectro - t)
-
-        # avoids randrange error if values are equal and range is empty
-        if (t_zero == t_zero + t): return cloned
-
-        mask_end = random.randrange(t_zero, t_zero + t)
-        if (replace_with_zero):
-            cloned[0][:, t_zero:mask_end] = 0
-        else:
-            cloned[0][:, t_zero:mask_end] = cloned.mean()
-    return cloned
+def spec_augment(inputs, lengths=None, freq_mask_param=15, num_freq_masks=2, time_mask_param=15, num_time_masks=2,
+                 replace_with_zero=True):
+    """
+    SpecAugment frequency and time masking of a whole padded batch, on the device of the batch. The masks of every
+    utterance are drawn at once as boolean tensors; time masks stay within the true length of the utterance.
+    :param inputs: (batch, 1, freq, time) spectrograms as produced by _collate_fn
+    :param lengths: (batch,) number of valid frames, defaults to the full width
+    :param freq_mask_param: Masks are up to this many frequency bins wide
+    :param time_mask_param: Masks are up to this many frames wide
+    :param replace_with_zero: Fill masks with zero, otherwise with the mean of the utterance
+    """
+    batch_size, _, freq_size, max_seqlength = inputs.size()
+    device = inputs.device
+    if lengths is None:
+        lengths = torch.full((batch_size,), max_seqlength, dtype=torch.long)
+    lengths = lengths.to(device).long().clamp(max=max_seqlength)
+    frames = torch.arange(max_seqlength, device=device)
+    valid = frames.unsqueeze(0) < lengths.unsqueeze(1)
+
+    def draw(size, param, num_masks):
+        size = size.float().unsqueeze(1)
+        width = (torch.rand(batch_size, num_masks, device=device) * torch.clamp(size, max=param)).long()
+        start = (torch.rand(batch_size, num_masks, device=device) * (size - width.float())).long()
+        return start.unsqueeze(2), (start + width).unsqueeze(2)
+
+    start, end = draw(torch.full((batch_size,), freq_size, device=device), freq_mask_param, num_freq_masks)
+    bins = torch.arange(freq_size, device=device)
+    freq = ((bins >= start) & (bins < end)).any(1)
+    start, end = draw(lengths, time_mask_param, num_time_masks)
+    time = ((frames >= start) & (frames < end)).any(1)
+
+    mask = (freq.unsqueeze(2) | time.unsqueeze(1)) & valid.unsqueeze(1)
+    mask = mask.unsqueeze(1)
+    if replace_with_zero:
+        return inputs.masked_fill(mask, 0)
+    valid = valid.view(batch_size, 1, 1, max_seqlength).to(inputs.dtype)
+    mean = (inputs * valid).sum(dim=(1, 2, 3)) / (valid.sum(dim=(1, 2, 3)) * freq_size).clamp(min=1)
+    return torch.where(mask, mean.view(batch_size, 1, 1, 1), inputs)
 
 
 def load_audio(path):
@@ -158,43 +145,81 @@ class NoiseInjection(object):
     def __init__(self,
                  path=None,
                  sample_rate=16000,
-                 noise_levels=(0, 0.5)):
+                 noise_levels=(0, 0.5),
+                 cache_dir=None):
         """
         Adds noise to an input signal with specific SNR. Higher the noise level, the more noise added.
+        The recordings of path are decoded once into a memory-mapped NoiseBank in cache_dir, so noise crops are
+        array slices.
         Modified code from https://github.com/willfrey/audio/blob/master/torchaudio/transforms.py
         """
         if not os.path.exists(path):
             print("Directory doesn't exist: {}".format(path))
             raise IOError
         self.paths = path is not None and librosa.util.find_files(path)
+        self.bank = NoiseBank(self.paths, sample_rate, cache_dir=cache_dir)
+        self.noise_ids = dict((noise_path, i) for i, noise_path in enumerate(self.bank.paths))
         self.sample_rate = sample_rate
         self.noise_levels = noise_levels
 
     def inject_noise(self, data):
-        noise_path = np.random.choice(self.paths)
+        noise_id = np.random.randint(len(self.bank))
         noise_level = np.random.uniform(*self.noise_levels)
-        return self.inject_noise_sample(data, noise_path, noise_level)
+        return self._inject(data, noise_id, noise_level)
 
     def inject_noise_sample(self, data, noise_path, noise_level):
-        noise_len = get_audio_length(noise_path)
-        data_len = len(data) / self.sample_rate
-        noise_start = np.random.rand() * (noise_len - data_len)
-        noise_end = noise_start + data_len
-        noise_dst = audio_with_sox(noise_path, self.sample_rate, noise_start, noise_end)
-        assert len(data) == len(noise_dst)
-        noise_energy = np.sqrt(noise_dst.dot(noise_dst) / noise_dst.size)
-        data_energy = np.sqrt(data.dot(data) / data.size)
-        data += noise_level * noise_dst * data_energy / noise_energy
-        return data
+        return self._inject(data, self.noise_ids[noise_path], noise_level)
+
+    def _inject(self, data, noise_id, noise_level):
+        waves = torch.from_numpy(np.ascontiguousarray(data, dtype=np.float32)).unsqueeze(0)
+        waves = self.mix(waves, torch.LongTensor([len(data)]), torch.LongTensor([noise_id]),
+                         torch.FloatTensor([noise_level]))
+        return waves[0].numpy()
+
+    def inject_noise_batch(self, waves, lengths, noise_prob=1.0):
+        """
+        Adds noise to the rows of a (batch, samples) tensor with probability noise_prob, each with its own noise
+        recording and level.
+        """
+        batch_size = waves.size(0)
+        noise_ids = torch.randint(len(self.bank), (batch_size,))
+        noise_levels = torch.empty(batch_size).uniform_(*self.noise_levels)
+        noise_levels *= torch.bernoulli(torch.full((batch_size,), float(noise_prob)))
+        return self.mix(waves, lengths, noise_ids, noise_levels)
+
+    def mix(self, waves, lengths, noise_ids, noise_levels):
+        """
+        Crops a random segment of every noise recording and adds it scaled to noise_level times the signal energy.
+        """
+        lengths = lengths.to(waves.device)
+        noise_lengths = torch.from_numpy(self.bank.index[:, LENGTH])[noise_ids].to(lengths.dtype)
+        starts = (torch.rand(len(noise_ids)) * (noise_lengths.cpu() - lengths.cpu()).clamp(min=0).float()).long()
+        noise = self.bank.crop(noise_ids, starts, waves.size(1)).to(waves.device, waves.dtype)
+        mask = (torch.arange(waves.size(1), device=waves.device).unsqueeze(0) < lengths.unsqueeze(1)).to(waves.dtype)
+        noise = noise * mask
+        num_samples = lengths.to(waves.dtype).clamp(min=1)
+        data_energy = torch.sqrt((waves * waves * mask).sum(1) / num_samples)
+        noise_energy = torch.sqrt((noise * noise).sum(1) / num_samples)
+        # silent crop of a non silent recording, fall back to the energy of the whole recording
+        bank_energy = torch.from_numpy(self.bank.energies)[noise_ids].sqrt().to(waves.device, waves.dtype)
+        noise_energy = torch.where(noise_energy > 0, noise_energy, bank_energy).clamp(min=1e-8)
+        scale = noise_levels.to(waves.device, waves.dtype) * data_energy / noise_energy
+        return waves + noise * scale.unsqueeze(1)
 
 
 class SpectrogramParser(AudioParser):
-    def __init__(self, audio_conf, normalize=False, augment=False, specaugment=False, mel_filterbank=False):
+    def __init__(self, audio_conf, normalize=False, augment=False, specaugment=False, mel_filterbank=False,
+                 raw_audio=False):
         """
         Parses audio file into spectrogram with optional normalization and various augmentations
         :param audio_conf: Dictionary containing the sample rate, window and the window length/stride in seconds
         :param normalize(default False):  Apply standard mean and deviation normalization to audio tensor
-        :param augment(default False):  Apply random tempo and gain perturbations
+        :param augment(default False):  Apply random tempo and gain perturbations. audio_conf['augment_backend']
+        selects the in-process 'native' implementation (default) or 'sox', and audio_conf['speed_range'] adds
+        resampling based speed perturbation to the native one
+        :param mel_filterbank(default False): Project the spectrogram on audio_conf['n_mels'] (default 128) mel bands
+        :param raw_audio(default False): Return the augmented signal instead of its spectrogram, for models that
+        compute features on the batch with models.frontend.SpectrogramFrontend
         """
         super(SpectrogramParser, self).__init__()
         self.window_stride = audio_conf['window_stride']
@@ -203,41 +228,53 @@ class SpectrogramParser(AudioParser):
         self.window = windows.get(audio_conf['window'], windows['hamming'])
         self.normalize = normalize
         self.augment = augment
+        self.augment_backend = audio_conf.get('augment_backend', 'native')
+        self.speed_range = audio_conf.get('speed_range')
         self.noiseInjector = NoiseInjection(audio_conf['noise_dir'], self.sample_rate,
-                                            audio_conf['noise_levels']) if audio_conf.get(
+                                            audio_conf['noise_levels'],
+                                            audio_conf.get('noise_cache_dir')) if audio_conf.get(
             'noise_dir') is not None else None
         self.noise_prob = audio_conf.get('noise_prob')
         self.specaugment = specaugment
         self.mel_filterbank = mel_filterbank
+        self.n_mels = audio_conf.get('n_mels', 128)
+        self.raw_audio = raw_audio
 
     def parse_audio(self, audio_path):
-        if self.augment:
+        if self.augment and self.augment_backend == 'sox':
             y = load_randomly_augmented_audio(audio_path, self.sample_rate)
-        else:
-            y = load_audio(audio_path)
+            return self.parse_signal(y, augment=False)
+        return self.parse_signal(load_audio(audio_path))
+
+    def parse_signal(self, y, augment=None):
+        """
+        :param y: Audio signal as a float array sampled at sample_rate
+        :param augment: Overrides self.augment, used when the signal was already augmented by sox
+        :return: Spectrogram of the signal, or the (1, samples) signal itself with raw_audio
+        """
+        if self.augment if augment is None else augment:
+            y = randomly_augment_audio(y, self.sample_rate, speed_range=self.speed_range)
         if self.noiseInjector:
             add_noise = np.random.binomial(1, self.noise_prob)
             if add_noise:
                 y = self.noiseInjector.inject_noise(y)
+        if self.raw_audio:
+            return torch.FloatTensor(y).unsqueeze(0)
         n_fft = int(self.sample_rate * self.window_size)
         win_length = n_fft
         hop_length = int(self.sample_rate * self.window_stride)
-        if self.mel_filterbank is True :
-            librosa.filters.mel(sr=self.sample_rate, n_fft=n_fft,
-                                nmels=128)
-        else:
-            # STFT
-            D = librosa.stft(y, n_fft=n_fft, hop_length=hop_length,
-                            win_length=win_length, window=self.window)
-            spect, phase = librosa.magphase(D)
-            # S = log(S+1)
-            spect = np.log1p(spect)
-            spect = torch.FloatTensor(spect)
-
-        if self.specaugment:
-            raise NotImplementedError
-            # spect = time_mask(freq_mask(time_warp(spect), num_masks=2), num_masks=2)
-            # spect = spect.view(spect.shape[1],spect.shape[2])
+        # STFT
+        D = librosa.stft(y, n_fft=n_fft, hop_length=hop_length,
+                         win_length=win_length, window=self.window)
+        spect, phase = librosa.magphase(D)
+        if self.mel_filterbank is True:
+            mel_basis = librosa.filters.mel(sr=self.sample_rate, n_fft=n_fft, n_mels=self.n_mels)
+            spect = np.dot(mel_basis, spect)
+        # S = log(S+1)
+        spect = np.log1p(spect)
+        spect = torch.FloatTensor(spect)
+
+        # specaugment is applied on the collated batch, see spec_augment
         if self.normalize:
             mean = spect.mean()
             std = spect.std()
@@ -253,12 +290,15 @@ class SpectrogramParser(AudioParser):
 
 
 class SpectrogramDataset(Dataset, SpectrogramParser):
-    def __init__(self, audio_conf, manifest_filepath, labels, normalize=False, augment=False, specaugment=False):
+    def __init__(self, audio_conf, manifest_filepath, labels, normalize=False, augment=False, specaugment=False,
+                 feature_cache=None, raw_audio=False, lean=False, manifest_index=False):
         """
         Dataset that loads tensors via a csv containing file paths to audio files and transcripts separated by
-        a comma. Each new line is a different sample. Example below:
+        a comma. Each new line is a different sample. Manifests written by create_manifest also carry the duration
+        in seconds and the number of samples. Example below:
 
         /path/to/audio.wav,/path/to/audio.txt
+        /path/to/audio.wav,/path/to/audio.txt,1.2000,19200
         ...
 
         :param audio_conf: Dictionary containing the sample rate, window and the window length/stride in seconds
@@ -266,30 +306,117 @@ class SpectrogramDataset(Dataset, SpectrogramParser):
         :param labels: String containing all the possible characters to map to
         :param normalize: Apply standard mean and deviation normalization to audio tensor
         :param augment(default False):  Apply random tempo and gain perturbations
+        :param feature_cache(default None): Directory of features precomputed by data/feature_cache.py, read
+        instead of the audio whenever augmentation and noise injection are off. A manifest without extracted
+        features falls back to decoding the audio
+        :param raw_audio(default False): Return (1, samples) signals instead of spectrograms, see SpectrogramParser
+        :param lean(default False): Return only the spectrogram and the transcript as a LongTensor, batched by
+        BatchCollator, instead of also the one-hot transcript and the labels map
+        :param manifest_index(default False): Read the manifest through a memory-mapped ManifestIndex, built next
+        to the manifest on first use, instead of parsing it into Python lists
         """
-        with open(manifest_filepath) as f:
-            ids = f.readlines()
-        ids = [x.strip().split(',') for x in ids]
-        self.ids = ids
-        self.size = len(ids)
+        if manifest_index:
+            self.ids = ManifestIndex.open(manifest_filepath, labels)
+            self.durations = self.ids.durations
+        else:
+            with open(manifest_filepath) as f:
+                ids = f.readlines()
+            self.ids = [x.strip().split(',') for x in ids]
+            self.durations = [float(x[2]) for x in self.ids] if self.ids and len(self.ids[0]) > 2 else None
+        self.size = len(self.ids)
         self.labels_map = dict([(labels[i], i) for i in range(len(labels))])
-        super(SpectrogramDataset, self).__init__(audio_conf, normalize, augment, specaugment)
+        self.label_table = label_table(labels)
+        self.lean = lean
+        super(SpectrogramDataset, self).__init__(audio_conf, normalize, augment, specaugment, raw_audio=raw_audio)
+        self.feature_cache = None
+        if feature_cache is not None and not augment and self.noiseInjector is None and not raw_audio:
+            self.feature_cache = FeatureCache.open(feature_cache, audio_conf, manifest_filepath, normalize,
+                                                   required=False)
+            if self.feature_cache is None:
+                print("No feature cache for {} in {}, decoding the audio".format(manifest_filepath, feature_cache))
+            else:
+                assert len(self.feature_cache) == self.size
 
     def __getitem__(self, index):
         sample = self.ids[index]
-        spect, transcript = self.parse_audio(sample[-2]), self.parse_transcript(sample[-1])
-        transcript_one_hot = torch.nn.functional.one_hot(torch.LongTensor(transcript), num_classes=len(self.labels_map))
-        return spect, transcript, transcript_one_hot, self.labels_map
+        if self.feature_cache is not None:
+            spect = self.feature_cache[index]
+        else:
+            spect = self.parse_audio(sample[0])
+        if isinstance(self.ids, ManifestIndex):
+            # view of the transcript tokenized when the index was built
+            transcript = torch.from_numpy(self.ids.tokens(index))
+        else:
+            transcript = torch.LongTensor(self.parse_transcript(load_transcript(sample[1])))
+        if self.lean:
+            return spect, transcript
+        transcript = transcript.long()
+        transcript_one_hot = torch.nn.functional.one_hot(transcript, num_classes=len(self.labels_map))
+        return spect, transcript.tolist(), transcript_one_hot, self.labels_map
+
+    def frame_lengths(self):
+        """
+        :return: Number of spectrogram frames of every utterance, from the manifest durations or the audio headers
+        """
+        if self.durations is not None:
+            num_samples = np.round(np.asarray(self.durations, dtype=np.float64) * self.sample_rate)
+        else:
+            num_samples = np.array([get_audio_info(sample[0])[0] for sample in self.ids], dtype=np.float64)
+        hop_length = int(self.sample_rate * self.window_stride)
+        return (num_samples // hop_length).astype(np.int64) + 1
+
+    def label_lengths(self):
+        """
+        :return: Number of labels of every transcript
+        """
+        if isinstance(self.ids, ManifestIndex):
+            return np.asarray(self.ids.label_lengths, dtype=np.int64)
+        return np.array([len(self.parse_transcript(load_transcript(sample[1]))) for sample in self.ids],
+                        dtype=np.int64)
 
     def parse_transcript(self, transcript):
-        transcript = transcript.replace('\n', '')
-        transcript = list(filter(None, [self.labels_map.get(x.upper()) for x in list(transcript)]))
-        return transcript
+        return tokenize(transcript, self.label_table).tolist()
 
     def __len__(self):
         return self.size
 
 
+class PackedSpectrogramDataset(SpectrogramDataset):
+    def __init__(self, audio_conf, shards_path, labels, normalize=False, augment=False, specaugment=False,
+                 raw_audio=False, lean=False):
+        """
+        Dataset over shards written by data/audio_shards.py. Rows keep the order of the source manifest, so the
+        bins of BucketingSampler map to contiguous regions of a shard and are read sequentially.
+        :param shards_path: Directory holding meta.json, index.npy and the shard files
+        """
+        self.shards = AudioShards(shards_path)
+        if self.shards.sample_rate != audio_conf['sample_rate']:
+            raise ValueError("Shards are sampled at {} Hz, audio_conf expects {}".format(
+                self.shards.sample_rate, audio_conf['sample_rate']))
+        if augment and audio_conf.get('augment_backend', 'native') == 'sox':
+            raise ValueError("Tempo and gain augmentation with sox needs the audio files")
+        self.size = len(self.shards)
+        self.durations = self.shards.durations
+        self.labels_map = dict([(labels[i], i) for i in range(len(labels))])
+        self.label_table = label_table(labels)
+        self.lean = lean
+        self.feature_cache = None
+        SpectrogramParser.__init__(self, audio_conf, normalize, augment, specaugment, raw_audio=raw_audio)
+
+    def __getitem__(self, index):
+        pcm, transcript = self.shards[index]
+        spect = self.parse_signal(pcm_to_float(pcm))
+        transcript = self.parse_transcript(transcript)
+        if self.lean:
+            return spect, torch.LongTensor(transcript)
+        transcript_one_hot = torch.nn.functional.one_hot(torch.LongTensor(transcript), num_classes=len(self.labels_map))
+        return spect, transcript, transcript_one_hot, self.labels_map
+
+    def label_lengths(self):
+        return np.array([len(self.parse_transcript(transcript)) for _, _, transcript in self.shards],
+                        dtype=np.int64)
+
+
 def _collate_fn(batch):
     def func(p):
         return p[0].size(1)
@@ -329,13 +456,214 @@ def _collate_fn(batch):
     return inputs, targets, input_percentages, target_sizes, targets_one_hot, targets_list, labels_map
 
 
+class BatchCollator(object):
+    def __init__(self, num_buffers=0, pin_memory=False, share_memory=False, pad_label=0):
+        """
+        Collates the (spectrogram, transcript tensor) samples of lean datasets. Returns the same tensors as
+        _collate_fn minus the one-hot targets and the labels map, with the number of valid frames (samples for raw
+        audio) instead of their fraction of the longest: inputs, targets, input_sizes, target_sizes and targets_list,
+        padded through a length mask instead of Python lists.
+        With num_buffers > 0 the inputs are written into a ring of buffers that grow to the largest batch seen,
+        so batches stop allocating once the longest bucket went through.
+        :param num_buffers: Size of the ring. A buffer is overwritten num_buffers batches later, so it has to exceed
+        the batches of a worker alive at the same time (the prefetched ones plus the one being trained on)
+        :param pin_memory: Page-locked buffers for non blocking copies to the GPU, only in the main process
+        :param share_memory: Shared memory buffers, batches of worker processes then reach the main process
+        without a copy
+        :param pad_label: Label written after the end of every target in targets_list
+        """
+        self.buffers = [dict() for _ in range(num_buffers)]
+        self.pin_memory = pin_memory
+        self.share_memory = share_memory
+        self.pad_label = pad_label
+        self.step = 0
+
+    def _empty(self, slot, name, size, dtype):
+        if slot is None:
+            return torch.empty(size, dtype=dtype)
+        numel = int(np.prod(size))
+        buffer = slot.get(name)
+        if buffer is None or buffer.numel() < numel or buffer.dtype != dtype:
+            buffer = torch.empty(numel, dtype=dtype)
+            if self.pin_memory:
+                buffer = buffer.pin_memory()
+            if self.share_memory:
+                buffer.share_memory_()
+            slot[name] = buffer
+        return buffer[:numel].view(size)
+
+    def __call__(self, batch):
+        seq_lengths, order = torch.LongTensor([sample[0].size(1) for sample in batch]).sort(descending=True)
+        batch = [batch[i] for i in order.tolist()]
+        minibatch_size = len(batch)
+        freq_size = batch[0][0].size(0)
+        max_seqlength = int(seq_lengths[0])
+
+        slot = None
+        if self.buffers:
+            slot = self.buffers[self.step % len(self.buffers)]
+            self.step += 1
+        inputs = self._empty(slot, 'inputs', (minibatch_size, 1, freq_size, max_seqlength), torch.float)
+        for x, (tensor, _) in enumerate(batch):
+            seq_length = tensor.size(1)
+            inputs[x, 0, :, :seq_length].copy_(tensor)
+            inputs[x, 0, :, seq_length:].zero_()
+        input_sizes = seq_lengths.int()
+
+        transcripts = [transcript for _, transcript in batch]
+        target_sizes = torch.IntTensor([len(transcript) for transcript in transcripts])
+        targets = torch.cat(transcripts).long()
+        max_target = int(target_sizes.max())
+        targets_list = torch.full((minibatch_size, max_target), self.pad_label, dtype=torch.long)
+        targets_list[torch.arange(max_target).unsqueeze(0) < target_sizes.long().unsqueeze(1)] = targets
+
+        return inputs, targets, input_sizes, target_sizes, targets_list
+
+
+class PrefetchStats(object):
+    def __init__(self):
+        """
+        Counters of a prefetching iteration. `stall_time` is the time the training loop waited for batches, the
+        queue depth is sampled whenever a batch is taken: a depth near zero means loading is the bottleneck.
+        """
+        self.batches = 0
+        self.stall_time = 0.
+        self.stalls = 0
+        self.total_depth = 0
+        self.max_depth = 0
+
+    def update(self, depth, stall_time):
+        self.batches += 1
+        self.stall_time += stall_time
+        self.stalls += depth == 0
+        self.total_depth += depth
+        self.max_depth = max(self.max_depth, depth)
+
+    @property
+    def mean_depth(self):
+        return self.total_depth / float(max(self.batches, 1))
+
+    def __str__(self):
+        return 'batches %d, stalled %d times for %.3fs, queue depth mean %.2f max %d' % (
+            self.batches, self.stalls, self.stall_time, self.mean_depth, self.max_depth)
+
+
+class _Failure(object):
+    def __init__(self, exception):
+        self.exception = exception
+
+
+_END = object()
+# inputs and targets_list of a batch, the sizes stay on the host like in the synchronous path
+_DEVICE_FIELDS = (0, 4)
+
+
+def _prefetch(iterator, batches, done, device, stream):
+    """
+    Producer of _PrefetchIterator. Holds no reference to the iterator object, so dropping it (e.g. breaking out of
+    the epoch) sets `done` through __del__ and ends the thread.
+    """
+    def put(item):
+        # give up when the consumer went away, instead of blocking on a full queue forever
+        while not done.is_set():
+            try:
+                batches.put(item, timeout=.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    try:
+        for batch in iterator:
+            event = None
+            if stream is not None:
+                with torch.cuda.stream(stream):
+                    batch = tuple(x.pin_memory().to(device, non_blocking=True) if i in _DEVICE_FIELDS else x
+                                  for i, x in enumerate(batch))
+                    event = torch.cuda.Event()
+                    event.record(stream)
+            if not put((batch, event)):
+                return
+    except Exception as e:
+        put(_Failure(e))
+        return
+    put(_END)
+
+
+class _PrefetchIterator(object):
+    def __init__(self, iterator, depth, device, stats):
+        """
+        Pulls batches of `iterator` on a background thread into a queue of `depth` batches. On a CUDA device, the
+        tensors are pinned and copied with non blocking copies on a side stream, so the copy of the next batches
+        overlaps the current step.
+        """
+        self.queue = queue.Queue(maxsize=depth)
+        self.device = device
+        self.stats = stats
+        self.done = threading.Event()
+        stream = torch.cuda.Stream(device) if device is not None and device.type == 'cuda' else None
+        self.thread = threading.Thread(target=_prefetch, args=(iterator, self.queue, self.done, device, stream))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        depth = self.queue.qsize()
+        start = time.time()
+        item = self.queue.get()
+        if item is _END:
+            self.done.set()
+            raise StopIteration
+        if isinstance(item, _Failure):
+            self.done.set()
+            raise item.exception
+        self.stats.update(depth, time.time() - start)
+        batch, event = item
+        if event is not None:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(event)
+            for i in _DEVICE_FIELDS:
+                # the memory was allocated on the side stream
+                batch[i].record_stream(stream)
+        return batch
+
+    def close(self):
+        self.done.set()
+
+    def __del__(self):
+        self.close()
+
+
 class AudioDataLoader(DataLoader):
     def __init__(self, *args, **kwargs):
         """
-        Creates a data loader for AudioDatasets.
+        Creates a data loader for AudioDatasets. Lean datasets are collated by BatchCollator, which takes the
+        additional `num_buffers` argument.
+        With `prefetch` > 0, a background thread keeps that many batches ready. Given a CUDA `device`, their
+        tensors are already on it, copied on a side stream; counters of the last iteration are in `stats`.
         """
+        num_buffers = kwargs.pop('num_buffers', 0)
+        prefetch = kwargs.pop('prefetch', 0)
+        device = kwargs.pop('device', None)
         super(AudioDataLoader, self).__init__(*args, **kwargs)
-        self.collate_fn = _collate_fn
+        if getattr(self.dataset, 'lean', False):
+            self.collate_fn = BatchCollator(num_buffers,
+                                            pin_memory=self.pin_memory and self.num_workers == 0,
+                                            share_memory=self.num_workers > 0)
+        else:
+            self.collate_fn = _collate_fn
+        self.prefetch = prefetch
+        self.device = torch.device(device) if device is not None else None
+        self.stats = PrefetchStats()
+
+    def __iter__(self):
+        iterator = super(AudioDataLoader, self).__iter__()
+        if not self.prefetch:
+            return iterator
+        self.stats = PrefetchStats()
+        return _PrefetchIterator(iterator, self.prefetch, self.device, self.stats)
 
 
 class BucketingSampler(Sampler):
@@ -381,15 +709,26 @@ class BatchRandomSampler(Sampler):
 
 
 class DistributedBucketingSampler(Sampler):
-    def __init__(self, data_source, batch_size=1, num_replicas=None, rank=None):
+    def __init__(self, data_source, batch_size=1, num_replicas=None, rank=None, balance=None, strategy='lpt',
+                 num_buckets=10):
         """
         Samples batches assuming they are in order of size to batch similarly sized samples together.
+        :param balance: None gives every rank every Nth bin. 'frames' or 'joint' instead split the
+        num_replicas x batch_size utterances of every step between the ranks so each gets the same total frames,
+        or frames x (labels + 1), the size of the RNN-T lattice
+        :param strategy: With balance, 'lpt' assigns the longest utterances first and 'greedy' in shuffled order,
+        each to the least loaded rank that has room left
+        :param num_buckets: With balance, utterances are shuffled within this many duration buckets every epoch
         """
         super(DistributedBucketingSampler, self).__init__(data_source)
         if num_replicas is None:
             num_replicas = get_world_size()
         if rank is None:
             rank = get_rank()
+        if balance not in (None, 'frames', 'joint'):
+            raise ValueError('Invalid balance mode selected.')
+        if strategy not in ('lpt', 'greedy'):
+            raise ValueError('Invalid balance strategy selected.')
         self.data_source = data_source
         self.ids = list(range(0, len(data_source)))
         self.batch_size = batch_size
@@ -398,8 +737,55 @@ class DistributedBucketingSampler(Sampler):
         self.rank = rank
         self.num_samples = int(math.ceil(len(self.bins) * 1.0 / self.num_replicas))
         self.total_size = self.num_samples * self.num_replicas
+        self.balance = balance
+        self.strategy = strategy
+        self.num_buckets = num_buckets
+        self.costs = None
+        self.steps = None
+        if balance is not None:
+            self.costs = self._costs(balance)
+            self.steps = self._balanced_steps(0)
+            self.num_samples = len(self.steps)
+
+    def _costs(self, mode):
+        costs = np.asarray(self.data_source.frame_lengths(), dtype=np.float64)
+        if mode == 'joint':
+            costs = costs * (np.asarray(self.data_source.label_lengths(), dtype=np.float64) + 1)
+        return costs
+
+    def _balanced_steps(self, epoch):
+        rng = np.random.RandomState(epoch)
+        order = np.argsort(self.costs, kind='mergesort')
+        buckets = np.array_split(order, min(self.num_buckets, max(len(order), 1)))
+        for bucket in buckets:
+            rng.shuffle(bucket)
+        pool_size = self.batch_size * self.num_replicas
+        num_steps = int(math.ceil(len(order) * 1.0 / pool_size))
+        # repeat utterances to make it evenly divisible
+        pools = np.resize(np.concatenate(buckets), num_steps * pool_size).reshape(num_steps, pool_size)
+        return [self._partition(pools[i]) for i in rng.permutation(num_steps)]
+
+    def _partition(self, pool):
+        if self.strategy == 'lpt':
+            pool = pool[np.argsort(-self.costs[pool], kind='mergesort')]
+        batches = [[] for _ in range(self.num_replicas)]
+        heap = [(0., rank) for rank in range(self.num_replicas)]
+        for i in pool:
+            load, rank = heapq.heappop(heap)
+            batches[rank].append(int(i))
+            if len(batches[rank]) < self.batch_size:
+                heapq.heappush(heap, (load + self.costs[i], rank))
+        return batches
+
+    def _steps(self):
+        if self.steps is not None:
+            return self.steps
+        bins = self.bins + self.bins[:(self.total_size - len(self.bins))]
+        return [bins[i:i + self.num_replicas] for i in range(0, len(bins), self.num_replicas)]
 
     def __iter__(self):
+        if self.steps is not None:
+            return iter([step[self.rank] for step in self.steps])
         offset = self.rank
         # add extra samples to make it evenly divisible
         bins = self.bins + self.bins[:(self.total_size - len(self.bins))]
@@ -411,12 +797,121 @@ class DistributedBucketingSampler(Sampler):
         return self.num_samples
 
     def shuffle(self, epoch):
+        if self.steps is not None:
+            self.steps = self._balanced_steps(epoch)
+            return
         # deterministically shuffle based on epoch
         g = torch.Generator()
         g.manual_seed(epoch)
         bin_ids = list(torch.randperm(len(self.bins), generator=g))
         self.bins = [self.bins[i] for i in bin_ids]
 
+    def imbalance(self):
+        """
+        Every rank computes the assignment of all ranks, so this needs no communication.
+        :return: The total cost of every rank divided by the mean over ranks, and the mean over steps of the slowest
+        rank's cost divided by the mean, the factor synchronous steps wait for stragglers
+        """
+        costs = self.costs if self.costs is not None else self._costs('frames')
+        loads = np.array([[costs[batch].sum() for batch in step] for step in self._steps()])
+        totals = loads.sum(axis=0)
+        per_step = loads.max(axis=1) / np.maximum(loads.mean(axis=1), 1e-12)
+        return totals / max(totals.mean(), 1e-12), float(per_step.mean())
+
+
+class FrameBudgetSampler(Sampler):
+    def __init__(self, data_source, max_frames, mode='frames', num_buckets=10, max_batch_size=None):
+        """
+        Packs batches up to a budget instead of a fixed batch size, so long and short utterances cost the same
+        memory per batch.
+        :param max_frames: Budget of a batch. With mode 'frames' it bounds batch size x longest spectrogram, with
+        mode 'joint' batch size x longest spectrogram x (longest transcript + 1), the lattice RNN-T allocates
+        :param num_buckets: Utterances are shuffled within this many duration buckets before packing
+        :param max_batch_size: Optional upper bound of utterances per batch
+        """
+        super(FrameBudgetSampler, self).__init__(data_source)
+        if mode not in ('frames', 'joint'):
+            raise ValueError('Invalid budget mode selected.')
+        self.data_source = data_source
+        self.max_frames = max_frames
+        self.mode = mode
+        self.num_buckets = num_buckets
+        self.max_batch_size = max_batch_size
+        self.frame_lengths = np.asarray(data_source.frame_lengths())
+        self.label_lengths = np.asarray(data_source.label_lengths()) + 1 if mode == 'joint' else None
+        self.bins = self._pack(np.argsort(self.frame_lengths, kind='mergesort'))
+
+    def _cost(self, size, max_t, max_u):
+        if self.mode == 'joint':
+            return size * max_t * max_u
+        return size * max_t
+
+    def _pack(self, ids):
+        bins = []
+        batch, max_t, max_u = [], 0, 0
+        for i in ids:
+            t = int(self.frame_lengths[i])
+            u = int(self.label_lengths[i]) if self.label_lengths is not None else 1
+            full = self.max_batch_size is not None and len(batch) >= self.max_batch_size
+            if batch and (full or self._cost(len(batch) + 1, max(max_t, t), max(max_u, u)) > self.max_frames):
+                bins.append(batch)
+                batch, max_t, max_u = [], 0, 0
+            batch.append(int(i))
+            max_t, max_u = max(max_t, t), max(max_u, u)
+        if batch:
+            bins.append(batch)
+        return bins
+
+    def _shuffled_bins(self, epoch):
+        rng = np.random.RandomState(epoch)
+        order = np.argsort(self.frame_lengths, kind='mergesort')
+        buckets = np.array_split(order, min(self.num_buckets, max(len(order), 1)))
+        for bucket in buckets:
+            rng.shuffle(bucket)
+        bins = self._pack(np.concatenate(buckets))
+        return [bins[i] for i in rng.permutation(len(bins))]
+
+    def __iter__(self):
+        return iter(self.bins)
+
+    def __len__(self):
+        return len(self.bins)
+
+    def shuffle(self, epoch):
+        self.bins = self._shuffled_bins(epoch)
+
+
+class DistributedFrameBudgetSampler(FrameBudgetSampler):
+    def __init__(self, data_source, max_frames, mode='frames', num_buckets=10, max_batch_size=None,
+                 num_replicas=None, rank=None):
+        """
+        FrameBudgetSampler for distributed training. Every rank packs the same batches from the same seed and takes
+        every Nth of them; the batch list is padded so all ranks run the same number of steps.
+        """
+        if num_replicas is None:
+            num_replicas = get_world_size()
+        if rank is None:
+            rank = get_rank()
+        self.num_replicas = num_replicas
+        self.rank = rank
+        super(DistributedFrameBudgetSampler, self).__init__(data_source, max_frames, mode, num_buckets,
+                                                            max_batch_size)
+        self.num_samples = int(math.ceil(len(self.bins) * 1.0 / self.num_replicas))
+        self.total_size = self.num_samples * self.num_replicas
+
+    def __iter__(self):
+        # add extra batches to make it evenly divisible
+        bins = self.bins + self.bins[:(self.total_size - len(self.bins))]
+        return iter(bins[self.rank::self.num_replicas])
+
+    def __len__(self):
+        return self.num_samples
+
+    def shuffle(self, epoch):
+        super(DistributedFrameBudgetSampler, self).shuffle(epoch)
+        self.num_samples = int(math.ceil(len(self.bins) * 1.0 / self.num_replicas))
+        self.total_size = self.num_samples * self.num_replicas
+
 
 def get_audio_length(path):
     output = subprocess.check_output(['soxi -D \"%s\"' % path.strip()], shell=True)
@@ -465,3 +960,115 @@ def load_randomly_augmented_audio(path, sample_rate=16000, tempo_range=(0.85, 1.
     audio = augment_audio_with_sox(path=path, sample_rate=sample_rate,
                                    tempo=tempo_value, gain=gain_value)
     return audio
+
+
+def speed_perturb(waves, lengths, rates):
+    """
+    Resampling based speed perturbation of a batch, like sox `speed`: a rate above 1 shortens the recording and
+    raises its pitch. Every row is resampled with its own rate by linear interpolation.
+    :param waves: (batch, samples) float tensor
+    :param lengths: (batch,) number of valid samples of every row
+    :param rates: (batch,) speed factors
+    :return: Perturbed batch and its lengths
+    """
+    rates = rates.to(waves.dtype).to(waves.device)
+    lengths = lengths.to(waves.device)
+    new_lengths = torch.ceil(lengths.to(rates.dtype) / rates).long()
+    positions = torch.arange(int(new_lengths.max()), device=waves.device, dtype=rates.dtype)
+    positions = positions.unsqueeze(0) * rates.unsqueeze(1)
+    last = (lengths - 1).clamp(min=0).unsqueeze(1)
+    left = positions.floor().long().clamp(max=waves.size(1) - 1)
+    left = torch.min(left, last)
+    right = torch.min(left + 1, last)
+    weight = positions - left.to(rates.dtype)
+    out = torch.gather(waves, 1, left) * (1 - weight) + torch.gather(waves, 1, right) * weight
+    mask = torch.arange(out.size(1), device=waves.device).unsqueeze(0) < new_lengths.unsqueeze(1)
+    return out * mask.to(out.dtype), new_lengths
+
+
+def tempo_perturb(waves, lengths, tempos, sample_rate=16000, segment=.082, search=.01468, overlap=.012):
+    """
+    Tempo change of a batch without changing the pitch, the in-process counterpart of sox `tempo` (WSOLA with the
+    same segment, search and overlap defaults). Segments are read every (segment - overlap) * tempo seconds, shifted
+    within the search window to best match the previous segment and cross-faded every (segment - overlap) seconds.
+    Only the search runs segment by segment; it is vectorized over the batch.
+    :param waves: (batch, samples) float tensor
+    :param lengths: (batch,) number of valid samples of every row
+    :param tempos: (batch,) tempo factors, above 1 is faster
+    :return: Perturbed batch and its lengths
+    """
+    segment_length = int(sample_rate * segment)
+    search_length = int(sample_rate * search)
+    overlap_length = int(sample_rate * overlap)
+    hop_length = segment_length - overlap_length
+    batch_size, device = waves.size(0), waves.device
+    tempos = tempos.to(torch.float64).to(device)
+    lengths = lengths.to(device)
+    new_lengths = torch.round(lengths.to(tempos.dtype) / tempos).long()
+    num_segments = int(math.ceil(float(new_lengths.max()) / hop_length)) + 1
+
+    def read(starts, size):
+        index = starts.unsqueeze(-1) + torch.arange(size, device=device)
+        valid = (index >= 0) & (index < lengths.view((-1,) + (1,) * (index.dim() - 1)))
+        index = index.clamp(0, waves.size(1) - 1)
+        values = torch.gather(waves, 1, index.view(batch_size, -1)).view(index.size())
+        return values * valid.to(waves.dtype)
+
+    nominal = torch.arange(num_segments, device=device, dtype=tempos.dtype).unsqueeze(0)
+    nominal = torch.round(nominal * hop_length * tempos.unsqueeze(1)).long()
+    offsets = torch.arange(search_length, device=device)
+    positions = [nominal[:, 0]]
+    for k in range(1, num_segments):
+        # the overlap that would naturally follow the previous segment
+        target = read(positions[-1] + hop_length, overlap_length)
+        candidates = read(nominal[:, k:k + 1] - search_length // 2 + offsets, overlap_length)
+        best = torch.argmax((candidates * target.unsqueeze(1)).sum(2), dim=1)
+        positions.append(nominal[:, k] - search_length // 2 + best)
+    segments = read(torch.stack(positions, dim=1), segment_length)
+
+    ramp = (torch.arange(overlap_length, dtype=waves.dtype, device=device) + .5) / overlap_length
+    window = torch.ones(segment_length, dtype=waves.dtype, device=device)
+    window[:overlap_length] = ramp
+    window[-overlap_length:] = 1 - ramp
+    output_size = (1, (num_segments - 1) * hop_length + segment_length)
+    out = torch.nn.functional.fold((segments * window).transpose(1, 2), output_size, (1, segment_length),
+                                   stride=(1, hop_length))
+    norm = torch.nn.functional.fold(window.view(1, -1, 1).expand(1, -1, num_segments), output_size,
+                                    (1, segment_length), stride=(1, hop_length))
+    out = (out / norm.clamp(min=1e-8)).view(batch_size, -1)[:, :int(new_lengths.max())]
+    mask = torch.arange(out.size(1), device=device).unsqueeze(0) < new_lengths.unsqueeze(1)
+    return out * mask.to(out.dtype), new_lengths
+
+
+def gain_perturb(waves, gains):
+    """
+    :param gains: (batch,) gains in dB
+    """
+    gains = gains.to(waves.dtype).to(waves.device)
+    return waves * torch.pow(10., gains / 20.).unsqueeze(1)
+
+
+def randomly_augment_batch(waves, lengths, sample_rate=16000, tempo_range=(0.85, 1.15), gain_range=(-6, 8),
+                           speed_range=None):
+    """
+    Picks tempo, gain and optionally speed uniformly for every row of the batch, with the same ranges as
+    load_randomly_augmented_audio, and applies them in-process.
+    """
+    batch_size = waves.size(0)
+    if speed_range is not None:
+        speeds = torch.empty(batch_size, dtype=torch.float64).uniform_(*speed_range)
+        waves, lengths = speed_perturb(waves, lengths, speeds)
+    tempos = torch.empty(batch_size, dtype=torch.float64).uniform_(*tempo_range)
+    waves, lengths = tempo_perturb(waves, lengths, tempos, sample_rate)
+    gains = torch.empty(batch_size, dtype=torch.float64).uniform_(*gain_range)
+    return gain_perturb(waves, gains), lengths
+
+
+def randomly_augment_audio(y, sample_rate=16000, tempo_range=(0.85, 1.15), gain_range=(-6, 8), speed_range=None):
+    """
+    Single utterance version of randomly_augment_batch working on a numpy signal.
+    """
+    waves = torch.from_numpy(np.ascontiguousarray(y, dtype=np.float32)).unsqueeze(0)
+    lengths = torch.LongTensor([len(y)])
+    waves, lengths = randomly_augment_batch(waves, lengths, sample_rate, tempo_range, gain_range, speed_range)
+    return waves[0, :int(lengths[0])].numpy()
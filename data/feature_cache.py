@@ -0,0 +1,183 @@
+import argparse
+import hashlib
+import json
+import os
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+parser = argparse.ArgumentParser(description='Precomputes spectrograms of a manifest into memory-mapped shards.')
+parser.add_argument('--manifest', metavar='DIR', help='path to manifest csv', required=True)
+parser.add_argument('--cache-dir', default='feature_cache/', help='Directory to store the feature shards')
+parser.add_argument('--sample-rate', default=16000, type=int, help='Sample rate')
+parser.add_argument('--window-size', default=.02, type=float, help='Window size for spectrogram in seconds')
+parser.add_argument('--window-stride', default=.01, type=float, help='Window stride for spectrogram in seconds')
+parser.add_argument('--window', default='hamming', help='Window type for spectrogram generation')
+parser.add_argument('--no-normalize', dest='normalize', action='store_false',
+                    help='Store features without per utterance mean and deviation normalization')
+parser.add_argument('--dtype', default='float16', choices=['float16', 'float32'], help='Storage type of features')
+parser.add_argument('--shard-size', default=1024, type=int, help='Maximum size of a shard file in MB')
+parser.add_argument('--num-workers', default=4, type=int, help='Number of processes used for extraction')
+
+SHARD_NAME = 'shard-%05d.bin'
+
+
+def _manifest_digest(manifest_filepath):
+    digest = hashlib.sha1()
+    with open(manifest_filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(audio_conf, manifest_filepath, normalize=False, mel_filterbank=False):
+    """
+    Key of the features of a manifest. Covers every setting that changes the spectrogram, so features extracted
+    with another configuration (or from another version of the manifest) are never picked up.
+    """
+    conf = dict(sample_rate=audio_conf['sample_rate'],
+                window_size=audio_conf['window_size'],
+                window_stride=audio_conf['window_stride'],
+                window=audio_conf['window'],
+                normalize=bool(normalize),
+                mel_filterbank=bool(mel_filterbank),
+                manifest=_manifest_digest(manifest_filepath))
+    return hashlib.sha1(json.dumps(conf, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class FeatureCache(object):
+    def __init__(self, path):
+        """
+        Read only view of features extracted by `extract_features`. Every utterance is a (freq, time) slice of a
+        memory-mapped shard, so indexing does not copy. Shards are mapped lazily, which keeps them out of the
+        pickled dataset handed to the data loader workers.
+        :param path: Directory holding meta.json, index.npy and the shard files
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.path = path
+        self.freq_size = self.meta['freq_size']
+        self.dtype = np.dtype(self.meta['dtype'])
+        self.index = np.load(os.path.join(path, 'index.npy'), mmap_mode='r')
+        self.shards = None
+
+    @classmethod
+    def open(cls, cache_dir, audio_conf, manifest_filepath, normalize=False, mel_filterbank=False, required=True):
+        """
+        :param required: Raise IOError when the features of the manifest were not extracted, otherwise return None
+        """
+        path = os.path.join(cache_dir, cache_key(audio_conf, manifest_filepath, normalize, mel_filterbank))
+        if not os.path.exists(os.path.join(path, 'meta.json')):
+            if not required:
+                return None
+            raise IOError("No feature cache for {} with this audio configuration in {}, "
+                          "run `python -m data.feature_cache` first".format(manifest_filepath, cache_dir))
+        return cls(path)
+
+    def _shard(self, shard_id):
+        if self.shards is None:
+            self.shards = {}
+        if shard_id not in self.shards:
+            # copy-on-write mapping: pages stay shared between workers and the tensors are writable
+            self.shards[shard_id] = np.memmap(os.path.join(self.path, SHARD_NAME % shard_id),
+                                              dtype=self.dtype, mode='c')
+        return self.shards[shard_id]
+
+    def __getitem__(self, index):
+        shard_id, offset, num_frames = self.index[index]
+        shard = self._shard(int(shard_id))
+        spect = shard[offset:offset + self.freq_size * num_frames]
+        return torch.from_numpy(spect).view(self.freq_size, int(num_frames))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shards'] = None
+        return state
+
+
+_worker_parser = None
+
+
+def _init_worker(audio_conf, normalize):
+    global _worker_parser
+    from data.data_loader import SpectrogramParser
+    _worker_parser = SpectrogramParser(audio_conf, normalize=normalize, augment=False)
+
+
+def _extract(audio_path):
+    return _worker_parser.parse_audio(audio_path).numpy()
+
+
+def extract_features(manifest_filepath, cache_dir, audio_conf, normalize=False, dtype='float16',
+                     shard_size=1 << 30, num_workers=4):
+    """
+    Runs the spectrogram extraction once for every utterance of the manifest and appends the features to shard
+    files of at most `shard_size` bytes. The index holds (shard, offset, frames) for each manifest row.
+    :return: Directory of the cache
+    """
+    audio_conf = dict(audio_conf, noise_dir=None)
+    path = os.path.join(cache_dir, cache_key(audio_conf, manifest_filepath, normalize))
+    os.makedirs(path, exist_ok=True)
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        os.remove(os.path.join(path, 'meta.json'))
+    with open(manifest_filepath) as f:
+        audio_paths = [x.strip().split(',')[0] for x in f if x.strip()]
+
+    dtype = np.dtype(dtype)
+    index = np.zeros((len(audio_paths), 3), dtype=np.int64)
+    freq_size = None
+    shard_id, shard_bytes, shard_offset = 0, 0, 0
+    shard_file = open(os.path.join(path, SHARD_NAME % shard_id), 'wb')
+    with Pool(num_workers, initializer=_init_worker, initargs=(audio_conf, normalize)) as pool:
+        features = pool.imap(_extract, audio_paths, chunksize=16)
+        for i, spect in enumerate(tqdm(features, total=len(audio_paths))):
+            spect = np.ascontiguousarray(spect, dtype=dtype)
+            freq_size = spect.shape[0]
+            if shard_bytes > 0 and shard_bytes + spect.nbytes > shard_size:
+                shard_file.close()
+                shard_id, shard_bytes, shard_offset = shard_id + 1, 0, 0
+                shard_file = open(os.path.join(path, SHARD_NAME % shard_id), 'wb')
+            shard_file.write(spect.tobytes())
+            index[i] = (shard_id, shard_offset, spect.shape[1])
+            shard_bytes += spect.nbytes
+            shard_offset += spect.size
+    shard_file.close()
+
+    np.save(os.path.join(path, 'index.npy'), index)
+    # meta.json is written last and marks the cache as complete
+    meta = dict(manifest=os.path.abspath(manifest_filepath),
+                sample_rate=audio_conf['sample_rate'],
+                window_size=audio_conf['window_size'],
+                window_stride=audio_conf['window_stride'],
+                window=audio_conf['window'],
+                normalize=normalize,
+                dtype=dtype.name,
+                freq_size=freq_size,
+                num_shards=shard_id + 1,
+                num_utterances=len(audio_paths))
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return path
+
+
+def main():
+    args = parser.parse_args()
+    audio_conf = dict(sample_rate=args.sample_rate,
+                      window_size=args.window_size,
+                      window_stride=args.window_stride,
+                      window=args.window)
+    path = extract_features(args.manifest, args.cache_dir, audio_conf,
+                            normalize=args.normalize,
+                            dtype=args.dtype,
+                            shard_size=args.shard_size << 20,
+                            num_workers=args.num_workers)
+    print('Features saved to', path)
+
+
+if __name__ == '__main__':
+    main()
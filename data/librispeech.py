@@ -2,8 +2,13 @@ import os
 import wget
 import tarfile
 import argparse
-import subprocess
-from data.utils import create_manifest
+from multiprocessing import Pool
+
+import numpy as np
+import scipy.signal
+import soundfile
+from data.audio_shards import write_pcm
+from data.utils import PrepJournal, write_manifest
 from tqdm import tqdm
 import shutil
 
@@ -19,7 +24,8 @@ parser.add_argument('--min-duration', default=1, type=int,
                     help='Prunes training samples shorter than the min duration (given in seconds, default 1)')
 parser.add_argument('--max-duration', default=15, type=int,
                     help='Prunes training samples longer than the max duration (given in seconds, default 15)')
-args = parser.parse_args()
+parser.add_argument('--num-workers', default=None, type=int,
+                    help='Processes converting audio, defaults to the number of cpus')
 
 LIBRI_SPEECH_URLS = {
     "train": [
@@ -31,44 +37,75 @@ def _preprocess_transcript(phrase):
     return phrase.strip().upper()
 
 
-def _process_file(wav_dir, txt_dir, base_filename, root_dir):
-    full_recording_path = os.path.join(root_dir, base_filename)
-    assert os.path.exists(full_recording_path) and os.path.exists(root_dir)
-    wav_recording_path = os.path.join(wav_dir, base_filename.replace(".flac", ".wav"))
-    subprocess.call(["sox {}  -r {} -b 16 -c 1 {}".format(full_recording_path, str(args.sample_rate),
-                                                          wav_recording_path)], shell=True)
-    # process transcript
-    txt_transcript_path = os.path.join(txt_dir, base_filename.replace(".flac", ".txt"))
-    transcript_file = os.path.join(root_dir, "-".join(base_filename.split('-')[:-1]) + ".trans.txt")
-    assert os.path.exists(transcript_file), "Transcript file {} does not exist.".format(transcript_file)
-    transcriptions = open(transcript_file).read().strip().split("\n")
-    transcriptions = {t.split()[0].split("-")[-1]: " ".join(t.split()[1:]) for t in transcriptions}
-    with open(txt_transcript_path, "w") as f:
-        key = base_filename.replace(".flac", "").split("-")[-1]
-        assert key in transcriptions, "{} is not in the transcriptions".format(key)
-        f.write(_preprocess_transcript(transcriptions[key]))
-        f.flush()
-    os.remove(full_recording_path)
+def _decode(path, sample_rate):
+    pcm, file_sample_rate = soundfile.read(path, dtype='int16')
+    if pcm.ndim > 1:
+        pcm = pcm.mean(axis=1)
+    if file_sample_rate != sample_rate:
+        gcd = np.gcd(file_sample_rate, sample_rate)
+        pcm = scipy.signal.resample_poly(pcm.astype(np.float32), sample_rate // gcd, file_sample_rate // gcd)
+        pcm = np.clip(np.round(pcm), -32768, 32767)
+    return pcm.astype(np.int16)
+
+
+def _process_chapter(job):
+    """
+    Converts the flac files of a chapter directory to wav and writes their transcripts from the chapter's
+    trans.txt, read once.
+    :return: Chapter key and the (wav, txt, duration, frames) rows of its utterances
+    """
+    key, chapter_dir, wav_dir, txt_dir, sample_rate = job
+    transcript_files = [f for f in os.listdir(chapter_dir) if f.endswith('.trans.txt')]
+    assert len(transcript_files) == 1, "Expected one transcript file in {}".format(chapter_dir)
+    with open(os.path.join(chapter_dir, transcript_files[0])) as f:
+        transcriptions = [line.split(' ', 1) for line in f.read().strip().split('\n')]
+    transcriptions = {utterance_id: text for utterance_id, text in transcriptions}
+
+    rows = []
+    for base_filename in sorted(f for f in os.listdir(chapter_dir) if f.endswith('.flac')):
+        utterance_id = base_filename[:-len('.flac')]
+        assert utterance_id in transcriptions, "{} is not in the transcriptions".format(utterance_id)
+        pcm = _decode(os.path.join(chapter_dir, base_filename), sample_rate)
+        wav_recording_path = os.path.join(wav_dir, utterance_id + '.wav')
+        write_pcm(wav_recording_path, pcm, sample_rate)
+        txt_transcript_path = os.path.join(txt_dir, utterance_id + '.txt')
+        with open(txt_transcript_path, 'w') as f:
+            f.write(_preprocess_transcript(transcriptions[utterance_id]))
+        rows.append((os.path.abspath(wav_recording_path), os.path.abspath(txt_transcript_path),
+                     len(pcm) / float(sample_rate), len(pcm)))
+    return key, rows
+
+
+def process_extracted(extracted_dir, wav_dir, txt_dir, journal, sample_rate=16000, num_workers=None):
+    """
+    Converts every chapter of an extracted archive that is not in the journal yet, recording each chapter once its
+    files are written.
+    """
+    jobs = []
+    for root, subdirs, files in os.walk(extracted_dir):
+        if any(f.endswith('.flac') for f in files):
+            key = os.path.relpath(root, extracted_dir)
+            if key not in journal:
+                jobs.append((key, root, wav_dir, txt_dir, sample_rate))
+    with Pool(num_workers) as pool:
+        for key, rows in tqdm(pool.imap_unordered(_process_chapter, jobs), total=len(jobs)):
+            journal.add(key, rows)
 
 
 def main():
+    args = parser.parse_args()
     target_dl_dir = args.target_dir
     if not os.path.exists(target_dl_dir):
         os.makedirs(target_dl_dir)
     files_to_dl = args.files_to_use.strip().split(',')
     for split_type, lst_libri_urls in LIBRI_SPEECH_URLS.items():
         split_dir = os.path.join(target_dl_dir, split_type)
-        if not os.path.exists(split_dir):
-            os.makedirs(split_dir)
         split_wav_dir = os.path.join(split_dir, "wav")
-        if not os.path.exists(split_wav_dir):
-            os.makedirs(split_wav_dir)
         split_txt_dir = os.path.join(split_dir, "txt")
-        if not os.path.exists(split_txt_dir):
-            os.makedirs(split_txt_dir)
+        os.makedirs(split_wav_dir, exist_ok=True)
+        os.makedirs(split_txt_dir, exist_ok=True)
+        journal = PrepJournal(os.path.join(split_dir, '.prep_journal.jsonl'))
         extracted_dir = os.path.join(split_dir, "LibriSpeech")
-        if os.path.exists(extracted_dir):
-            shutil.rmtree(extracted_dir)
         for url in lst_libri_urls:
             # check if we want to dl this file
             dl_flag = False
@@ -79,28 +116,31 @@ def main():
                 print("Skipping url: {}".format(url))
                 continue
             filename = url.split("/")[-1]
+            if 'archive:' + filename in journal:
+                print("Already processed {}".format(filename))
+                continue
             target_filename = os.path.join(split_dir, filename)
-            if not os.path.exists(target_filename):
-                wget.download(url, split_dir)
-            print("Unpacking {}...".format(filename))
-            tar = tarfile.open(target_filename)
-            tar.extractall(split_dir)
-            tar.close()
-            os.remove(target_filename)
+            if 'extracted:' + filename not in journal:
+                if not os.path.exists(target_filename):
+                    wget.download(url, split_dir)
+                print("Unpacking {}...".format(filename))
+                tar = tarfile.open(target_filename)
+                tar.extractall(split_dir)
+                tar.close()
+                journal.add('extracted:' + filename)
+                os.remove(target_filename)
             print("Converting flac files to wav and extracting transcripts...")
             assert os.path.exists(extracted_dir), "Archive {} was not properly uncompressed.".format(filename)
-            for root, subdirs, files in tqdm(os.walk(extracted_dir)):
-                for f in files:
-                    if f.find(".flac") != -1:
-                        _process_file(wav_dir=split_wav_dir, txt_dir=split_txt_dir,
-                                      base_filename=f, root_dir=root)
-
+            process_extracted(extracted_dir, split_wav_dir, split_txt_dir, journal, args.sample_rate,
+                              args.num_workers)
+            journal.add('archive:' + filename)
             print("Finished {}".format(url))
             shutil.rmtree(extracted_dir)
         if split_type == 'train':  # Prune to min/max duration
-            create_manifest(split_dir, 'libri_' + split_type + '_manifest.csv', args.min_duration, args.max_duration)
+            write_manifest(journal.rows(), 'libri_' + split_type + '_manifest.csv', args.min_duration,
+                           args.max_duration)
         else:
-            create_manifest(split_dir, 'libri_' + split_type + '_manifest.csv')
+            write_manifest(journal.rows(), 'libri_' + split_type + '_manifest.csv')
 
 
 if __name__ == "__main__":
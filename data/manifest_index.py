@@ -0,0 +1,208 @@
+import argparse
+import json
+import os
+from array import array
+
+import numpy as np
+from tqdm import tqdm
+
+from data.audio_shards import load_transcript
+from data.utils import get_audio_info
+
+parser = argparse.ArgumentParser(description='Builds the memory-mapped index of a manifest.')
+parser.add_argument('--manifest', metavar='DIR', help='path to manifest csv', required=True)
+parser.add_argument('--labels-path', default='labels_eng.json', help='Contains all characters for transcription')
+
+INDEX_SUFFIX = '.index'
+INDEX_VERSION = 2
+# label 0, the RNN-T blank, is not in the label files
+BLANK = '_'
+
+
+def _manifest_stat(manifest_filepath):
+    stat = os.stat(manifest_filepath)
+    return dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+
+def load_labels(labels_path, blank=True):
+    """
+    Reads a label file, a json list of characters.
+    :param blank: Put BLANK in front, so the characters of the file are labels 1 to N. Without, label 0 of the file
+    is the blank, like in models trained before the blank was added
+    """
+    with open(labels_path, encoding='utf-8') as label_file:
+        labels = str(''.join(json.load(label_file)))
+    if BLANK in labels:
+        raise ValueError("{} contains the blank symbol {!r}".format(labels_path, BLANK))
+    return BLANK + labels if blank else labels
+
+
+def label_table(labels):
+    """
+    Lookup table from unicode code point to label index, -1 for characters that are not labels. Label 0 is the
+    blank and never read from a transcript.
+    """
+    table = np.full(max(ord(x) for x in labels) + 1, -1, dtype=np.int32)
+    for i, x in enumerate(labels[1:], 1):
+        table[ord(x)] = i
+    return table
+
+
+def tokenize(transcript, table):
+    """
+    Maps the upper cased characters of a transcript to label indices, dropping characters that are not labels.
+    Raises ValueError when the transcript contains BLANK.
+    """
+    if BLANK in transcript:
+        raise ValueError("Transcript contains the blank symbol {!r}: {!r}".format(BLANK, transcript))
+    codes = np.frombuffer(transcript.replace('\n', '').upper().encode('utf-32-le'), dtype=np.uint32)
+    tokens = table[codes[codes < len(table)]]
+    return tokens[tokens >= 0]
+
+
+def build_index(manifest_filepath, path, labels):
+    """
+    Streams a manifest into the files of a ManifestIndex. paths.bin holds the utf-8 audio and transcript entries of
+    all rows back to back and offsets.npy the 2 * rows + 1 boundaries between them. Durations come from the third
+    manifest column or the audio headers. Transcripts are tokenized once into tokens.bin, whose row boundaries are
+    in token_offsets.npy.
+    """
+    os.makedirs(path, exist_ok=True)
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        os.remove(os.path.join(path, 'meta.json'))
+    stat = _manifest_stat(manifest_filepath)
+    table = label_table(labels)
+    token_dtype = np.int16 if len(labels) <= np.iinfo(np.int16).max else np.int32
+
+    offsets = array('q', [0])
+    token_offsets = array('q', [0])
+    durations = array('f')
+    with open(manifest_filepath, encoding='utf-8') as manifest, \
+            open(os.path.join(path, 'paths.bin'), 'wb') as f, \
+            open(os.path.join(path, 'tokens.bin'), 'wb') as token_file:
+        for line in tqdm(manifest):
+            sample = line.strip().split(',')
+            if not sample[0]:
+                continue
+            for entry in sample[:2]:
+                entry = entry.encode('utf-8')
+                f.write(entry)
+                offsets.append(offsets[-1] + len(entry))
+            if len(sample) > 2:
+                durations.append(float(sample[2]))
+            else:
+                num_samples, sample_rate = get_audio_info(sample[0])
+                durations.append(num_samples / float(sample_rate))
+            tokens = tokenize(load_transcript(sample[1]), table).astype(token_dtype)
+            token_file.write(tokens.tobytes())
+            token_offsets.append(token_offsets[-1] + len(tokens))
+
+    np.save(os.path.join(path, 'offsets.npy'), np.frombuffer(offsets, dtype=np.int64))
+    np.save(os.path.join(path, 'token_offsets.npy'), np.frombuffer(token_offsets, dtype=np.int64))
+    np.save(os.path.join(path, 'durations.npy'), np.frombuffer(durations, dtype=np.float32))
+    # meta.json is written last and marks the index as complete
+    meta = dict(stat, manifest=os.path.abspath(manifest_filepath), labels=labels, num_utterances=len(durations),
+                token_dtype=np.dtype(token_dtype).name, version=INDEX_VERSION)
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return path
+
+
+class ManifestIndex(object):
+    def __init__(self, path):
+        """
+        Array backed view of a manifest. Rows are decoded from a memory-mapped byte buffer on access, so opening is
+        O(1) and data loader workers share the pages instead of each holding millions of Python lists.
+        Indexing returns (audio path, transcript entry) like the rows of a parsed manifest, `tokens` the transcript
+        tokenized at build time.
+        :param path: Directory written by build_index
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.path = path
+        self.size = self.meta['num_utterances']
+        self.arrays = None
+
+    @classmethod
+    def open(cls, manifest_filepath, labels):
+        """
+        Opens the index stored next to a manifest, (re)building it when it is missing, the manifest changed, it was
+        built for other labels or by an older version.
+        """
+        path = manifest_filepath + INDEX_SUFFIX
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            stat = _manifest_stat(manifest_filepath)
+            if meta.get('version') == INDEX_VERSION and meta['size'] == stat['size'] and \
+                    meta['mtime_ns'] == stat['mtime_ns'] and meta['labels'] == labels:
+                return cls(path)
+        print("Indexing", manifest_filepath)
+        return cls(build_index(manifest_filepath, path, labels))
+
+    def _arrays(self):
+        if self.arrays is None:
+            paths_file = os.path.join(self.path, 'paths.bin')
+            if os.path.getsize(paths_file) > 0:
+                paths = np.memmap(paths_file, dtype=np.uint8, mode='r')
+            else:
+                paths = np.zeros(0, dtype=np.uint8)
+            tokens_file = os.path.join(self.path, 'tokens.bin')
+            token_dtype = np.dtype(self.meta['token_dtype'])
+            if os.path.getsize(tokens_file) > 0:
+                # copy-on-write mapping: pages stay shared between workers and torch accepts the slices
+                tokens = np.memmap(tokens_file, dtype=token_dtype, mode='c')
+            else:
+                tokens = np.zeros(0, dtype=token_dtype)
+            self.arrays = dict(paths=paths,
+                               offsets=np.load(os.path.join(self.path, 'offsets.npy'), mmap_mode='r'),
+                               tokens=tokens,
+                               token_offsets=np.load(os.path.join(self.path, 'token_offsets.npy'), mmap_mode='r'),
+                               durations=np.load(os.path.join(self.path, 'durations.npy'), mmap_mode='r'))
+        return self.arrays
+
+    @property
+    def durations(self):
+        return self._arrays()['durations']
+
+    @property
+    def label_lengths(self):
+        return np.diff(self._arrays()['token_offsets'])
+
+    def tokens(self, index):
+        """
+        :return: Label indices of the transcript of a row, a view of the token store
+        """
+        arrays = self._arrays()
+        start, end = arrays['token_offsets'][index:index + 2]
+        return arrays['tokens'][start:end]
+
+    def __getitem__(self, index):
+        arrays = self._arrays()
+        start, middle, end = arrays['offsets'][2 * index:2 * index + 3]
+        paths = arrays['paths']
+        return bytes(paths[start:middle]).decode('utf-8'), bytes(paths[middle:end]).decode('utf-8')
+
+    def __iter__(self):
+        for index in range(self.size):
+            yield self[index]
+
+    def __len__(self):
+        return self.size
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['arrays'] = None
+        return state
+
+
+def main():
+    args = parser.parse_args()
+    labels = load_labels(args.labels_path)
+    index = ManifestIndex.open(args.manifest, labels)
+    print('Indexed', len(index), 'utterances in', index.path)
+
+
+if __name__ == '__main__':
+    main()
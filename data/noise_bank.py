@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import scipy.signal
+import torch
+import torch.distributed as dist
+import torchaudio
+from tqdm import tqdm
+
+# columns of index.npy
+OFFSET, LENGTH = range(2)
+
+
+def _bank_key(paths, sample_rate):
+    digest = hashlib.sha1(str(sample_rate).encode('utf-8'))
+    for path in paths:
+        digest.update(('%s\t%r\n' % (os.path.abspath(path), os.path.getmtime(path))).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def default_cache_dir():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+                        'noise_bank')
+
+
+def _decode(path, sample_rate):
+    sound, file_sample_rate = torchaudio.load(path)
+    sound = sound.numpy().T
+    if len(sound.shape) > 1:
+        sound = sound.mean(axis=1)
+    if file_sample_rate != sample_rate:
+        gcd = np.gcd(int(file_sample_rate), int(sample_rate))
+        sound = scipy.signal.resample_poly(sound, sample_rate // gcd, file_sample_rate // gcd)
+    return sound.astype(np.float32)
+
+
+class NoiseBank(object):
+    def __init__(self, paths, sample_rate=16000, cache_dir=None):
+        """
+        Noise recordings decoded once at sample_rate into a single memory-mapped float32 file, with the offset,
+        length and mean energy of every recording. Cropping a noise segment is an array slice and the mapping is
+        shared by all data loader workers. The bank is rebuilt when a recording is added or modified.
+        In distributed training only rank 0 builds the bank, the other ranks wait for it.
+        :param paths: Noise recordings
+        :param cache_dir: Writable directory of the bank, defaults to default_cache_dir(), so the directory of the
+        recordings can be read only
+        """
+        self.paths = sorted(paths)
+        if not self.paths:
+            raise IOError("No noise recordings found")
+        if cache_dir is None:
+            cache_dir = default_cache_dir()
+        self.sample_rate = sample_rate
+        self.path = os.path.join(cache_dir, 'noise_bank_' + _bank_key(self.paths, sample_rate))
+        distributed = dist.is_available() and dist.is_initialized()
+        if not os.path.exists(os.path.join(self.path, 'meta.json')) and (not distributed or dist.get_rank() == 0):
+            self._build()
+        if distributed:
+            dist.barrier()
+        self.index = np.load(os.path.join(self.path, 'index.npy'))
+        self.energies = np.load(os.path.join(self.path, 'energies.npy'))
+        self.samples = None
+
+    def _build(self):
+        print("Decoding noise recordings into", self.path)
+        # built next to the final directory and renamed, runs sharing the cache never see a partial bank
+        path = '%s.tmp-%d' % (self.path, os.getpid())
+        os.makedirs(path, exist_ok=True)
+        index = np.zeros((len(self.paths), 2), dtype=np.int64)
+        energies = np.zeros(len(self.paths), dtype=np.float64)
+        offset = 0
+        with open(os.path.join(path, 'samples.bin'), 'wb') as f:
+            for i, path in enumerate(tqdm(self.paths)):
+                sound = _decode(path, self.sample_rate)
+                f.write(sound.tobytes())
+                index[i] = (offset, len(sound))
+                energies[i] = sound.astype(np.float64).dot(sound) / max(len(sound), 1)
+                offset += len(sound)
+        np.save(os.path.join(path, 'index.npy'), index)
+        np.save(os.path.join(path, 'energies.npy'), energies)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(dict(sample_rate=self.sample_rate, paths=self.paths), f, indent=2)
+        try:
+            os.rename(path, self.path)
+        except OSError:
+            # another run finished the same bank first
+            shutil.rmtree(path, ignore_errors=True)
+
+    def _samples(self):
+        if self.samples is None:
+            # copy-on-write mapping: pages stay shared between workers and torch accepts the array
+            self.samples = torch.from_numpy(np.memmap(os.path.join(self.path, 'samples.bin'), dtype=np.float32,
+                                                      mode='c'))
+        return self.samples
+
+    def crop(self, noise_ids, starts, size):
+        """
+        :param noise_ids: (batch,) recordings to crop
+        :param starts: (batch,) first sample of every crop, crops longer than the recording wrap around
+        :param size: Samples per crop
+        :return: (batch, size) crops
+        """
+        noise_ids = torch.as_tensor(noise_ids, dtype=torch.long)
+        index = torch.from_numpy(self.index)[noise_ids]
+        positions = torch.as_tensor(starts, dtype=torch.long).unsqueeze(1) + torch.arange(size)
+        positions = index[:, OFFSET].unsqueeze(1) + positions % index[:, LENGTH].unsqueeze(1)
+        return self._samples()[positions.view(-1)].view(len(noise_ids), size)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['samples'] = None
+        return state
@@ -2,9 +2,11 @@ from __future__ import print_function
 
 import fnmatch
 import io
+import json
 import os
+import struct
+from multiprocessing import Pool
 from tqdm import tqdm
-import subprocess
 import torch.distributed as dist
 import torch
 
@@ -55,33 +57,204 @@ class Corpus(object):
         return ids.view(batch_size, -1)
 
 
-def create_manifest(data_path, output_path, min_duration=None, max_duration=None):
+def create_manifest(data_path, output_path, min_duration=None, max_duration=None, num_workers=None,
+                    duration_index=None):
+    """
+    Writes a manifest of the wav files under data_path ordered by duration. Rows are
+    wav_path,transcript_path,duration,frames where frames is the number of samples per channel.
+    :param num_workers: Processes used to read audio headers, defaults to the number of cpus
+    :param duration_index: Path of the persistent duration index, defaults to data_path/.durations.tsv
+    """
     file_paths = [os.path.join(dirpath, f)
                   for dirpath, dirnames, files in os.walk(data_path)
                   for f in fnmatch.filter(files, '*.wav')]
-    file_paths = order_and_prune_files(file_paths, min_duration, max_duration)
+    if duration_index is None:
+        duration_index = os.path.join(data_path, '.durations.tsv')
+    file_paths = order_and_prune_files(file_paths, min_duration, max_duration, num_workers, duration_index)
+    write_manifest([(wav_path, wav_path.replace('/wav/', '/txt/').replace('.wav', '.txt'), duration, frames)
+                    for wav_path, duration, frames in file_paths], output_path)
+
+
+def write_manifest(rows, output_path, min_duration=None, max_duration=None):
+    """
+    Writes (wav_path, transcript_path, duration, frames) rows as a manifest ordered by duration, keeping the rows
+    between min_duration and max_duration when both are given.
+    """
+    if min_duration and max_duration:
+        print("Pruning manifests between %d and %d seconds" % (min_duration, max_duration))
+        rows = [row for row in rows if min_duration <= row[2] <= max_duration]
+    rows = sorted(rows, key=lambda row: row[2])
     with io.FileIO(output_path, "w") as file:
-        for wav_path in tqdm(file_paths, total=len(file_paths)):
-            transcript_path = wav_path.replace('/wav/', '/txt/').replace('.wav', '.txt')
-            sample = os.path.abspath(wav_path) + ',' + os.path.abspath(transcript_path) + '\n'
+        for wav_path, transcript_path, duration, frames in tqdm(rows, total=len(rows)):
+            sample = ','.join([os.path.abspath(wav_path), os.path.abspath(transcript_path),
+                               '%.4f' % duration, str(frames)]) + '\n'
             file.write(sample.encode('utf-8'))
     print('\n')
 
 
-def order_and_prune_files(file_paths, min_duration, max_duration):
+class PrepJournal(object):
+    def __init__(self, path):
+        """
+        Append-only record of the finished steps of a dataset preparation, one json line per step with the manifest
+        rows it produced. A restarted preparation skips the steps found in the journal.
+        """
+        self.path = path
+        self.entries = {}
+        torn = False
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # last line of a run that was killed while writing it
+                        torn = True
+                        break
+                    self.entries[entry['key']] = entry['rows']
+        if torn:
+            self._rewrite()
+
+    def _rewrite(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for key, rows in self.entries.items():
+                f.write(json.dumps(dict(key=key, rows=rows)) + '\n')
+        os.replace(tmp_path, self.path)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def add(self, key, rows=()):
+        rows = [list(row) for row in rows]
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(dict(key=key, rows=rows)) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries[key] = rows
+
+    def rows(self, prefix=''):
+        """
+        :return: Manifest rows of the finished steps whose key starts with prefix
+        """
+        return [tuple(row) for key, rows in self.entries.items() if key.startswith(prefix) for row in rows]
+
+
+def _read_wav_header(f):
+    riff = f.read(12)
+    if len(riff) < 12 or riff[:4] != b'RIFF' or riff[8:12] != b'WAVE':
+        raise ValueError('not a RIFF/WAVE file')
+    sample_rate, block_align = None, None
+    while True:
+        chunk = f.read(8)
+        if len(chunk) < 8:
+            raise ValueError('no data chunk')
+        chunk_id, chunk_size = chunk[:4], struct.unpack('<I', chunk[4:])[0]
+        if chunk_id == b'fmt ':
+            fmt = f.read(chunk_size + chunk_size % 2)
+            sample_rate = struct.unpack('<I', fmt[4:8])[0]
+            block_align = struct.unpack('<H', fmt[12:14])[0]
+        elif chunk_id == b'data':
+            if block_align is None:
+                raise ValueError('data chunk before fmt chunk')
+            return chunk_size // block_align, sample_rate
+        else:
+            f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+
+def _read_flac_header(f):
+    header = f.read(4)
+    if header[:3] == b'ID3':
+        # skip an ID3v2 tag written in front of the stream
+        tag = f.read(6)
+        size = (tag[2] << 21) | (tag[3] << 14) | (tag[4] << 7) | tag[5]
+        f.seek(size, os.SEEK_CUR)
+        header = f.read(4)
+    if header != b'fLaC':
+        raise ValueError('not a FLAC file')
+    block = f.read(4)
+    if block[0] & 0x7f != 0:
+        raise ValueError('first metadata block is not STREAMINFO')
+    info = f.read(34)
+    bits = int.from_bytes(info[10:18], 'big')
+    sample_rate = bits >> 44
+    frames = bits & ((1 << 36) - 1)
+    return frames, sample_rate
+
+
+def get_audio_info(path):
+    """
+    Reads the number of samples per channel and the sample rate from a WAV or FLAC header, without decoding.
+    """
+    with open(path, 'rb') as f:
+        if path.lower().endswith('.flac'):
+            return _read_flac_header(f)
+        return _read_wav_header(f)
+
+
+def _probe(path):
+    frames, sample_rate = get_audio_info(path)
+    return path, os.path.getmtime(path), frames, sample_rate
+
+
+class DurationIndex(object):
+    def __init__(self, path=None):
+        """
+        Persistent path -> (mtime, frames, sample rate) table stored as tsv. Entries whose file changed since they
+        were probed are probed again.
+        """
+        self.path = path
+        self.entries = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    file_path, mtime, frames, sample_rate = line.rstrip('\n').split('\t')
+                    self.entries[file_path] = (float(mtime), int(frames), int(sample_rate))
+
+    def probe(self, file_paths, num_workers=None):
+        """
+        :return: (duration, frames) of every path, reading only headers of new or modified files
+        """
+        missing = []
+        for path in file_paths:
+            entry = self.entries.get(path)
+            if entry is None or entry[0] != os.path.getmtime(path):
+                missing.append(path)
+        if missing:
+            with Pool(num_workers) as pool:
+                for path, mtime, frames, sample_rate in tqdm(pool.imap_unordered(_probe, missing, chunksize=64),
+                                                             total=len(missing)):
+                    self.entries[path] = (mtime, frames, sample_rate)
+            self.save()
+        return [(self.entries[path][1] / float(self.entries[path][2]), self.entries[path][1])
+                for path in file_paths]
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for path, (mtime, frames, sample_rate) in self.entries.items():
+                f.write('%s\t%r\t%d\t%d\n' % (path, mtime, frames, sample_rate))
+        os.rename(tmp_path, self.path)
+
+
+def order_and_prune_files(file_paths, min_duration, max_duration, num_workers=None, duration_index=None):
+    """
+    :return: (path, duration, frames) of the files sorted by duration
+    """
     print("Sorting manifests...")
-    duration_file_paths = [(path, float(subprocess.check_output(
-        ['soxi -D \"%s\"' % path.strip()], shell=True))) for path in file_paths]
+    durations = DurationIndex(duration_index).probe(file_paths, num_workers)
+    duration_file_paths = [(path, duration, frames) for path, (duration, frames) in zip(file_paths, durations)]
     if min_duration and max_duration:
         print("Pruning manifests between %d and %d seconds" % (min_duration, max_duration))
-        duration_file_paths = [(path, duration) for path, duration in duration_file_paths if
+        duration_file_paths = [(path, duration, frames) for path, duration, frames in duration_file_paths if
                                min_duration <= duration <= max_duration]
 
     def func(element):
         return element[1]
 
     duration_file_paths.sort(key=func)
-    return [x[0] for x in duration_file_paths]  # Remove durations
+    return duration_file_paths
 
 def reduce_tensor(tensor, world_size):
     rt = tensor.clone()
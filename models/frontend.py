@@ -0,0 +1,156 @@
+import librosa
+import scipy.signal
+import torch
+from torch import nn
+
+
+class SpectrogramFrontend(nn.Module):
+    def __init__(self, sample_rate=16000, window_size=.02, window_stride=.01, window='hamming', normalize=True,
+                 n_mels=None):
+        '''
+        Batched torch.stft feature extraction. Reproduces SpectrogramParser.parse_audio (log1p magnitude of a
+        centered, reflect padded STFT with a symmetric window, per utterance mean/std normalization) on a padded
+        batch of signals, so models trained on the worker features can be fed by this layer.
+        `n_mels`: project on this many mel bands before the log compression
+        '''
+        super(SpectrogramFrontend, self).__init__()
+        self.sample_rate = sample_rate
+        self.n_fft = int(sample_rate * window_size)
+        self.hop_length = int(sample_rate * window_stride)
+        self.normalize = normalize
+        # librosa calls the scipy window function, which gives the symmetric window
+        self.register_buffer('window', torch.FloatTensor(scipy.signal.get_window(window, self.n_fft, fftbins=False)))
+        if n_mels:
+            mel_basis = librosa.filters.mel(sr=sample_rate, n_fft=self.n_fft, n_mels=n_mels)
+            self.register_buffer('mel_basis', torch.FloatTensor(mel_basis))
+        else:
+            self.mel_basis = None
+
+    def get_seq_lens(self, lengths):
+        '''
+        `lengths`: number of samples of every signal
+        returns the number of spectrogram frames
+        '''
+        return lengths // self.hop_length + 1
+
+    def _pad(self, waves, lengths):
+        # reflect around the true ends of the signals instead of the end of the padded batch
+        pad = self.n_fft // 2
+        offsets = torch.arange(pad, device=waves.device)
+        left = waves[:, 1:pad + 1].flip(1)
+        padded = torch.cat([left, waves, waves.new_zeros(waves.size(0), pad)], dim=1)
+        source = (lengths.unsqueeze(1) - 2 - offsets).clamp(min=0)
+        padded.scatter_(1, pad + lengths.unsqueeze(1) + offsets, torch.gather(waves, 1, source))
+        return padded
+
+    def forward(self, waves, lengths):
+        '''
+        `waves`: (batch, samples) zero padded signals
+        `lengths`: (batch,) number of samples of every signal
+        returns (batch, 1, freq, frames) features, zero beyond the valid frames, and the number of valid frames
+        '''
+        lengths = lengths.to(waves.device).long()
+        frames = torch.stft(self._pad(waves, lengths), self.n_fft, hop_length=self.hop_length, win_length=self.n_fft,
+                            window=self.window, center=False, return_complex=True)
+        spect = frames.abs()
+        if self.mel_basis is not None:
+            spect = torch.matmul(self.mel_basis, spect)
+        spect = torch.log1p(spect)
+
+        seq_lens = self.get_seq_lens(lengths)
+        mask = (torch.arange(spect.size(2), device=waves.device).unsqueeze(0) < seq_lens.unsqueeze(1)).unsqueeze(1)
+        mask = mask.to(spect.dtype)
+        if self.normalize:
+            count = seq_lens.to(spect.dtype) * spect.size(1)
+            mean = (spect * mask).sum(dim=(1, 2)) / count
+            centered = (spect - mean.view(-1, 1, 1)) * mask
+            std = torch.sqrt((centered * centered).sum(dim=(1, 2)) / (count - 1))
+            spect = centered / std.view(-1, 1, 1)
+        else:
+            spect = spect * mask
+        return spect.unsqueeze(1), seq_lens
+
+
+class GlobalCMVN(nn.Module):
+    def __init__(self, mean, std):
+        '''
+        Per frequency bin normalization with global statistics (data/cmvn.py), replacing the per utterance mean/std
+        of the parsers. Applied as a single fused multiply-add, x * scale + shift, whose buffers are saved with the
+        model.
+        `mean`, `std`: (freq,) statistics of the unnormalized features
+        '''
+        super(GlobalCMVN, self).__init__()
+        scale = 1. / torch.as_tensor(std, dtype=torch.float)
+        self.register_buffer('scale', scale.view(-1, 1))
+        self.register_buffer('shift', (-torch.as_tensor(mean, dtype=torch.float) * scale).view(-1, 1))
+
+    @classmethod
+    def from_stats(cls, stats):
+        return cls(stats.mean, stats.std)
+
+    def forward(self, xs, lengths=None):
+        '''
+        `xs`: (batch, 1, freq, time) features
+        `lengths`: number of valid frames, frames beyond are set to zero
+        '''
+        xs = torch.addcmul(self.shift, xs, self.scale)
+        if lengths is not None:
+            xs = xs.masked_fill(_padding_mask(xs, lengths), 0)
+        return xs
+
+
+class StreamingCMVN(nn.Module):
+    def __init__(self, mean, std, window=300):
+        '''
+        Causal normalization for streaming: every frame is normalized with the mean and variance of the last `window`
+        frames of its stream. Until `window` frames were seen, the missing frames count with the global statistics.
+        `mean`, `std`: (freq,) global statistics of the unnormalized features (data/cmvn.py)
+        '''
+        super(StreamingCMVN, self).__init__()
+        self.window = window
+        mean = torch.as_tensor(mean, dtype=torch.double)
+        std = torch.as_tensor(std, dtype=torch.double)
+        self.register_buffer('mean', mean.view(-1, 1))
+        self.register_buffer('square', (std * std + mean * mean).view(-1, 1))
+
+    @classmethod
+    def from_stats(cls, stats, window=300):
+        return cls(stats.mean, stats.std, window)
+
+    def step(self, xs, state=None):
+        '''
+        `xs`: (batch, 1, freq, time) next chunk of every stream
+        `state`: returned by the previous chunk of the same streams, None at the start
+        returns the normalized chunk and the state for the next chunk
+        '''
+        history = xs.new_zeros(xs.size(0), 1, xs.size(2), 0) if state is None else state
+        frames = torch.cat([history, xs], dim=3)
+        offset = history.size(3)
+
+        # windowed sums from cumulative sums over time, with a leading zero
+        zero = frames.new_zeros(frames.size(0), 1, frames.size(2), 1).double()
+        sums = torch.cat([zero, frames.double().cumsum(3)], dim=3)
+        squares = torch.cat([zero, (frames.double() ** 2).cumsum(3)], dim=3)
+        end = torch.arange(offset + 1, offset + xs.size(3) + 1, device=xs.device)
+        start = (end - self.window).clamp(min=0)
+        prior = (self.window - (end - start)).double()
+
+        mean = (sums[..., end] - sums[..., start] + prior * self.mean) / self.window
+        square = (squares[..., end] - squares[..., start] + prior * self.square) / self.window
+        std = torch.sqrt((square - mean * mean).clamp(min=1e-10))
+        xs = ((xs.double() - mean) / std).to(xs.dtype)
+        return xs, frames[..., max(frames.size(3) - self.window + 1, 0):]
+
+    def forward(self, xs, lengths=None):
+        '''
+        Normalizes whole utterances as if they were streamed, frames beyond `lengths` are set to zero.
+        '''
+        xs, _ = self.step(xs)
+        if lengths is not None:
+            xs = xs.masked_fill(_padding_mask(xs, lengths), 0)
+        return xs
+
+
+def _padding_mask(xs, lengths):
+    frames = torch.arange(xs.size(3), device=xs.device)
+    return (frames.unsqueeze(0) >= lengths.to(xs.device).long().unsqueeze(1)).view(xs.size(0), 1, 1, xs.size(3))
@@ -1,8 +1,15 @@
 import math
+from collections import OrderedDict
 import torch
 from torch import nn, autograd
 import torch.nn.functional as F
-from warprnnt_pytorch import RNNTLoss
+from models.rnnt_loss import RNNTLoss, chunked_rnnt_loss, simple_rnnt_loss, prune_ranges, pruned_rnnt_loss, \
+    pruned_loss_scales
+
+try:
+    from warprnnt_pytorch import RNNTLoss as WarpRNNTLoss
+except ImportError:
+    WarpRNNTLoss = None
 
 
 class DecoderModel(nn.Module):
@@ -44,44 +51,106 @@ class DecoderModel(nn.Module):
 
 
 class EncoderModel(nn.Module):
-    def __init__(self, input_size, vocab_size, hidden_size, num_layers, dropout=.2, blank=0, bidirectional=False):
+    def __init__(self, input_size, vocab_size, hidden_size, num_layers, dropout=.2, blank=0, bidirectional=False,
+                 time_reduction=1, conv_subsampling=False):
+        '''
+        `time_reduction`: 1, 2, 4 or 8, the outputs of the first log2(time_reduction) LSTM layers are stacked in pairs
+        of frames (pyramid_stack), so every following layer runs at half the frame rate
+        `conv_subsampling`: replace the 1x1 convolutions by ConvSubsampling, which feeds the LSTMs hidden_size features
+        at a quarter of the frame rate
+        '''
         super(EncoderModel, self).__init__()
         self.hidden_size = hidden_size
         self.num_layers = num_layers
         self.vocab_size = vocab_size
         self.blank = blank
-
-        self.lstm = nn.LSTM(input_size, hidden_size, num_layers,
-                            batch_first=True, dropout=dropout, bidirectional=bidirectional)
+        if time_reduction not in (1, 2, 4, 8):
+            raise ValueError('Invalid time reduction %s' % time_reduction)
+        self.time_reduction = time_reduction
+        self.reductions = int(math.log(time_reduction, 2))
+        if self.reductions >= num_layers:
+            raise ValueError('time reduction %d needs more than %d encoder layers' % (time_reduction, num_layers))
+
+        self.conv_subsampling = conv_subsampling
+        if conv_subsampling:
+            self.subsampling = ConvSubsampling(input_size, hidden_size)
+            input_size = hidden_size
+
+        directions = 2 if bidirectional else 1
+        if time_reduction == 1:
+            self.lstm = nn.LSTM(input_size, hidden_size, num_layers,
+                                batch_first=True, dropout=dropout, bidirectional=bidirectional)
+        else:
+            # one LSTM per layer, the inputs of layers 1 to reductions are stacked to twice the width
+            self.lstm = nn.ModuleList()
+            for layer in range(int(num_layers)):
+                size = input_size if layer == 0 else hidden_size * directions * (2 if layer <= self.reductions else 1)
+                self.lstm.append(nn.LSTM(size, hidden_size, batch_first=True, bidirectional=bidirectional))
+            self.layer_dropout = nn.Dropout(dropout)
 
         if bidirectional:
             hidden_size *= 2
 
         self.linear = nn.Linear(hidden_size, vocab_size)
 
-        self.conv_1 = nn.Conv2d(1, 1, (1, 1), stride=1)
-        self.conv_2 = nn.Conv2d(1, 1, (1, 1), stride=1)
+        if not conv_subsampling:
+            self.conv_1 = nn.Conv2d(1, 1, (1, 1), stride=1)
+            self.conv_2 = nn.Conv2d(1, 1, (1, 1), stride=1)
 
-        self.batch_norm_1 = nn.BatchNorm2d(1)
-        self.batch_norm_2 = nn.BatchNorm2d(1)
+            self.batch_norm_1 = nn.BatchNorm2d(1)
+            self.batch_norm_2 = nn.BatchNorm2d(1)
 
-    def forward(self, xs, hid=None):
+    def forward(self, xs, hid=None, lengths=None):
+        '''
+        `xs`: (batch, 1, freq, time) features
+        `lengths`: number of valid frames of every utterance, padding frames are then left out of the batch norm
+        statistics and the LSTM runs on packed sequences
+        '''
         xs = torch.transpose(xs, 2, 3)
+        # models saved before the options have no attributes
+        if getattr(self, 'conv_subsampling', False):
+            xs = self.subsampling(xs)
+            lengths = None if lengths is None else self.subsampling.get_seq_lens(lengths)
+        else:
+            mask = None
+            if lengths is not None:
+                frames = torch.arange(xs.size(2), device=xs.device)
+                mask = (frames < lengths.to(xs.device).view(-1, 1)).to(xs.dtype).view(xs.size(0), 1, xs.size(2), 1)
 
-        xs = self.conv_1(xs)
-        xs = self.batch_norm_1(xs)
-        xs = self.conv_2(xs)
-
-        xs = xs.squeeze()
+            xs = self.conv_1(xs)
+            xs = masked_batch_norm(self.batch_norm_1, xs, mask)
+            xs = self.conv_2(xs)
 
-        output, hid = self.lstm(xs, hid)
+            xs = xs.squeeze(1)
 
-        # output, _ = self.pBLSTM_1(output)
-        # output = pyramid_stack(output)
-        # output, _ = self.pBLSTM_2(output)
+        if getattr(self, 'time_reduction', 1) == 1:
+            output, hid = run_rnn(self.lstm, xs, lengths, hid)
+        else:
+            # `hid` holds the states of every layer
+            output, states = xs, []
+            for layer, lstm in enumerate(self.lstm):
+                if layer > 0:
+                    output = self.layer_dropout(output)
+                if 0 < layer <= self.reductions:
+                    output = pyramid_stack(output)
+                    lengths = None if lengths is None else (lengths + 1) // 2
+                output, state = run_rnn(lstm, output, lengths, None if hid is None else hid[layer])
+                states.append(state)
+            hid = states
 
         return self.linear(output), hid
 
+    def get_seq_lens(self, lengths):
+        '''
+        `lengths`: number of input frames of every utterance
+        returns the number of output frames
+        '''
+        if getattr(self, 'conv_subsampling', False):
+            lengths = self.subsampling.get_seq_lens(lengths)
+        for _ in range(getattr(self, 'reductions', 0)):
+            lengths = (lengths + 1) // 2
+        return lengths
+
     def greedy_decode(self, xs):
         xs = self(xs)[0][0] # only one sequence
         xs = F.log_softmax(xs, dim=1)
@@ -89,38 +158,125 @@ class EncoderModel(nn.Module):
         return pred.data.cpu().numpy(), -float(logp.sum())
 
 
-def pyramid_stack(inputs):
-
-    size = inputs.size()
-
-    if int(size[1]) % 2 == 1:
-        padded_inputs = F.pad(inputs, (0, 0, 0, 1, 0, 0))
-        sequence_length = int(size[1]) + 1
+class ConvSubsampling(nn.Module):
+    def __init__(self, input_size, output_size, channels=32):
+        '''
+        Two 3x3 convolutions with stride 2 over time and frequency, each followed by a ReLU, and a projection of the
+        channels x remaining frequencies to `output_size`. Cuts the frame rate by 4 and the input_size frequency bins
+        to about a quarter.
+        '''
+        super(ConvSubsampling, self).__init__()
+        self.conv = nn.Sequential(nn.Conv2d(1, channels, 3, stride=2),
+                                  nn.ReLU(),
+                                  nn.Conv2d(channels, channels, 3, stride=2),
+                                  nn.ReLU())
+        self.linear = nn.Linear(channels * (((input_size - 1) // 2 - 1) // 2), output_size)
+
+    # the shortest input with one output frame
+    min_frames = 7
+
+    def get_seq_lens(self, lengths):
+        '''
+        `lengths`: number of input frames, at least `min_frames`
+        returns the number of output frames, which only depend on valid input frames
+        '''
+        if bool((lengths < self.min_frames).any()):
+            raise ValueError('ConvSubsampling needs utterances of at least %d frames, got %d, filter shorter ones '
+                             'from the manifest' % (self.min_frames, int(lengths.min())))
+        return ((lengths - 1) // 2 - 1) // 2
+
+    def forward(self, xs):
+        '''
+        `xs`: (batch, 1, time, freq) features
+        returns (batch, time', output_size)
+        '''
+        xs = self.conv(xs)
+        return self.linear(xs.transpose(1, 2).reshape(xs.size(0), xs.size(2), -1))
+
+
+def masked_batch_norm(norm, xs, mask=None):
+    '''
+    Applies the batch norm layer `norm` with statistics of the valid elements of the batch only, the running
+    statistics of `norm` are updated the same way.
+    `mask`: broadcastable to `xs`, 1 on valid and 0 on padding elements, None normalizes the whole batch
+    '''
+    if mask is None:
+        return norm(xs)
+    dims = [0] + list(range(2, xs.dim()))
+    shape = [1, -1] + [1] * (xs.dim() - 2)
+    if norm.training or not norm.track_running_stats:
+        count = mask.expand_as(xs).sum(dims)
+        mean = (xs * mask).sum(dims) / count
+        var = (((xs - mean.view(shape)) * mask) ** 2).sum(dims) / count
+        if norm.training and norm.track_running_stats:
+            with torch.no_grad():
+                norm.num_batches_tracked += 1
+                momentum = norm.momentum if norm.momentum is not None else 1. / float(norm.num_batches_tracked)
+                norm.running_mean.mul_(1 - momentum).add_(momentum * mean)
+                norm.running_var.mul_(1 - momentum).add_(momentum * var * count / (count - 1).clamp(min=1))
     else:
-        padded_inputs = inputs
-        sequence_length = int(size[1])
+        mean, var = norm.running_mean, norm.running_var
+    xs = (xs - mean.view(shape)) / torch.sqrt(var.view(shape) + norm.eps)
+    if norm.affine:
+        xs = xs * norm.weight.view(shape) + norm.bias.view(shape)
+    return xs * mask
 
-    odd_ind = torch.arange(1, sequence_length, 2, dtype=torch.long)
-    even_ind = torch.arange(0, sequence_length, 2, dtype=torch.long)
 
-    odd_inputs = padded_inputs[:, odd_ind, :]
-    even_inputs = padded_inputs[:, even_ind, :]
+def run_rnn(rnn, xs, lengths=None, hid=None):
+    '''
+    Runs the batch first `rnn` on packed sequences of `lengths` frames, the outputs are zero beyond them.
+    '''
+    if lengths is None:
+        return rnn(xs, hid)
+    packed = nn.utils.rnn.pack_padded_sequence(xs, lengths.cpu().long(), batch_first=True, enforce_sorted=False)
+    output, hid = rnn(packed, hid)
+    output, _ = nn.utils.rnn.pad_packed_sequence(output, batch_first=True, total_length=xs.size(1))
+    return output, hid
 
-    outputs_stacked = torch.cat([even_inputs, odd_inputs], 1)
 
-    return outputs_stacked
+def pyramid_stack(inputs):
+    '''
+    Concatenates pairs of consecutive frames along the feature axis, (batch, time, feature) to
+    (batch, ceil(time / 2), 2 * feature). An odd last frame is paired with a zero frame.
+    '''
+    if inputs.size(1) % 2 == 1:
+        inputs = F.pad(inputs, (0, 0, 0, 1))
+    return inputs.reshape(inputs.size(0), inputs.size(1) // 2, 2 * inputs.size(2))
 
 
 class Transducer(nn.Module):
-    def __init__(self, input_size, vocab_size, hidden_size, decoder_num_layers, encoder_num_layers, dropout=0.5, blank=0, bidirectional=False, LM_model_path=False):
+    def __init__(self, input_size, vocab_size, hidden_size, decoder_num_layers, encoder_num_layers, dropout=0.5, blank=0, bidirectional=False, LM_model_path=False, cmvn=None, loss='auto', joint_chunk=None, prune_range=None, prune_warmup=0, simple_loss_scale=0.5, time_reduction=1, conv_subsampling=False):
+        '''
+        `cmvn`: optional GlobalCMVN or StreamingCMVN applied to the features before the encoder, the statistics are
+        saved with the model
+        `loss`: 'builtin' for the PyTorch RNN-T loss of models/rnnt_loss.py, 'warp' for warp-transducer, 'auto' uses
+        warp-transducer on CUDA when it is installed and the builtin loss otherwise
+        `joint_chunk`: compute the joint and the builtin loss together in chunks of at most this many logits, which
+        are recomputed in backward instead of stored (chunked_rnnt_loss), None computes all logits at once
+        `prune_range`: train with the pruned loss, the joint runs on this many label positions per frame, chosen by
+        an additive joint of the encoder and prediction outputs trained alongside (pruned_rnnt_loss). In eval mode
+        the loss is the full (or chunked) lattice loss
+        `prune_warmup`: number of steps over which the pruned loss is phased in (pruned_loss_scales)
+        `simple_loss_scale`: weight of the loss of the additive joint after warm-up
+        `time_reduction`: frame rate reduction of the encoder, see EncoderModel
+        `conv_subsampling`: strided convolutions in front of the encoder LSTMs, see EncoderModel
+        '''
         super(Transducer, self).__init__()
+        self.cmvn = cmvn
         self.blank = blank
         self.vocab_size = vocab_size
         self.hidden_size = hidden_size
         self.decoder_num_layers = decoder_num_layers
         self.encoder_num_layers = encoder_num_layers
 
-        self.loss = RNNTLoss()
+        if loss not in ('auto', 'builtin', 'warp'):
+            raise ValueError('Invalid loss %s' % loss)
+        if loss == 'warp' and WarpRNNTLoss is None:
+            raise ValueError('loss is warp, but warprnnt_pytorch is not installed')
+        self.loss = RNNTLoss(blank=blank)
+        self.warp_loss = WarpRNNTLoss(blank=blank) if loss != 'builtin' and WarpRNNTLoss is not None else None
+        self.loss_backend = loss
+        self.joint_chunk = joint_chunk
 
         self.decoder = DecoderModel(embed_size=vocab_size,
                                     vocab_size=vocab_size,
@@ -135,23 +291,73 @@ class Transducer(nn.Module):
                                     hidden_size=hidden_size,
                                     num_layers=encoder_num_layers,
                                     dropout=dropout,
-                                    bidirectional=bidirectional)
+                                    bidirectional=bidirectional,
+                                    time_reduction=time_reduction,
+                                    conv_subsampling=conv_subsampling)
 
         self.fc1 = nn.Linear(2 * hidden_size, hidden_size)
         self.fc2 = nn.Linear(hidden_size, vocab_size)
         self.dropout = nn.Dropout(0.2)
 
-    def joint(self, f, g):
-        dim = len(f.shape) - 1
-
-        out = torch.cat((f, g), dim=dim)
-        out = F.tanh(self.fc1(out))
+        self.prune_range = prune_range
+        self.prune_warmup = prune_warmup
+        self.simple_loss_scale = simple_loss_scale
+        if prune_range:
+            self.simple_encoder = nn.Linear(hidden_size, vocab_size)
+            self.simple_decoder = nn.Linear(hidden_size, vocab_size)
+
+    def project_encoder(self, f):
+        # fc1 of cat(f, g) is the sum of a projection of f and one of g, the bias goes with f
+        return F.linear(f, self.fc1.weight[:, :self.hidden_size], self.fc1.bias)
+
+    def project_decoder(self, g):
+        return F.linear(g, self.fc1.weight[:, self.hidden_size:])
+
+    def joint(self, f, g, projected=False):
+        '''
+        `f`, `g`: encoder and prediction network outputs of broadcastable shapes, e.g. (B, T, 1, H) and (B, 1, U, H),
+        each is projected at its own size and only the sum is broadcast
+        `projected`: f and g are already outputs of project_encoder and project_decoder
+        '''
+        if not projected:
+            f = self.project_encoder(f)
+            g = self.project_decoder(g)
+        out = torch.tanh(f + g)
 
         return self.dropout(self.fc2(out))
 
-    def forward(self, xs, ys, xlen, ylen):
+    def rnnt_loss(self, out):
+        # models saved before the builtin loss hold the warp-transducer loss in self.loss
+        backend = getattr(self, 'loss_backend', None)
+        if backend == 'warp' or (backend == 'auto' and out.is_cuda and self.warp_loss is not None):
+            return self.warp_loss
+        return self.loss
+
+    def normalize(self, xs, xlen=None):
+        # models saved before the cmvn option have no attribute
+        cmvn = getattr(self, 'cmvn', None)
+        if cmvn is None:
+            return xs
+        return cmvn(xs, xlen)
+
+    def pruned_loss(self, f, g, ys, xlen, ylen, step=None):
+        simple_loss, occupancy = simple_rnnt_loss(self.simple_encoder(f), self.simple_decoder(g), ys, xlen, ylen,
+                                                  blank=self.blank)
+        starts, prune_range = prune_ranges(occupancy, xlen, ylen, self.prune_range)
+        pruned_loss = pruned_rnnt_loss(lambda f, g: self.joint(f, g, projected=True),
+                                       self.project_encoder(f), self.project_decoder(g), ys, xlen, ylen,
+                                       starts, prune_range, blank=self.blank)
+        simple_scale, pruned_scale = pruned_loss_scales(step, self.prune_warmup, self.simple_loss_scale)
+        return simple_scale * simple_loss + pruned_scale * pruned_loss
+
+    def forward(self, xs, ys, xlen, ylen, step=None):
+        '''
+        `step`: training step, sets the warm-up of the pruned loss, None after warm-up
+        '''
         # encoder
-        xs, _ = self.encoder(xs)
+        xlen = xlen.int()
+        xs, _ = self.encoder(self.normalize(xs, xlen), lengths=xlen)
+        xlen = self.encoder.get_seq_lens(xlen)
 
         # concat first zero
         zero = autograd.Variable(torch.zeros((ys.shape[0], 1)).long())
@@ -162,170 +368,331 @@ class Transducer(nn.Module):
         y_mat = torch.cat((zero, ys), dim=1)
         _, y_mat, _ = self.decoder(y_mat)
 
-        xs = xs.unsqueeze(dim=2)
-        y_mat = y_mat.unsqueeze(dim=1)
-
-        # expand
-        sz = [max(i, j) for i, j in zip(xs.size()[:-1], y_mat.size()[:-1])]
-        xs = xs.expand(torch.Size(sz + [xs.shape[-1]]));
-        y_mat = y_mat.expand(torch.Size(sz + [y_mat.shape[-1]]))
+        # models saved before the options have no attributes
+        # the pruned loss mixes in the simple loss, evaluation uses the full lattice to stay comparable
+        if getattr(self, 'prune_range', None) and self.training:
+            return self.pruned_loss(xs, y_mat, ys, xlen, ylen, step)
+        if getattr(self, 'joint_chunk', None):
+            return chunked_rnnt_loss(lambda f, g: self.joint(f, g, projected=True),
+                                     self.project_encoder(xs).unsqueeze(dim=2),
+                                     self.project_decoder(y_mat).unsqueeze(dim=1),
+                                     ys, xlen, ylen, self.vocab_size, blank=self.blank, max_elements=self.joint_chunk)
 
-        out = self.joint(xs, y_mat)
+        # (B, T, 1, H) + (B, 1, U + 1, H) broadcast in the joint
+        out = self.joint(xs.unsqueeze(dim=2), y_mat.unsqueeze(dim=1))
+        loss = self.rnnt_loss(out)
 
         if ys.is_cuda:
             xlen = xlen.cuda()
             ylen = ylen.cuda()
-        else:
+        elif not isinstance(loss, RNNTLoss):
+            # the CPU binding of warp-transducer takes normalized log probabilities
             out = F.log_softmax(out, dim=3)
             # NOTE loss function need flatten label
             ys = torch.cat([ys[i, :j] for i, j in enumerate(ylen.data)], dim=0).cpu()
 
-        xlen_temp = [i.shape[0] for i in out]
-        xlen = torch.LongTensor(xlen_temp)
-        xlen = xlen.type(torch.int32)
-        if ys.is_cuda:
-            xlen = xlen.cuda()
-
-#         print('out:', out)
-#         print('ys:', ys.int())
-        loss = self.loss(out, ys.int(), xlen, ylen)
-        return loss
-
-    def greedy_decode_batch(self, x):
-        output, _ = self.encoder(x)
+        return loss(out, ys.int(), xlen, ylen)
 
-        decoded = []
+    def encode(self, xs, xlen=None):
+        '''
+        Encoder outputs for decoding, already projected for the joint, and their number of valid frames.
+        '''
+        output, _ = self.encoder(self.normalize(xs, xlen), lengths=xlen)
+        if xlen is None:
+            lengths = torch.full((output.size(0),), output.size(1), dtype=torch.long, device=output.device)
+        else:
+            lengths = self.encoder.get_seq_lens(xlen).to(output.device).long()
+        return self.project_encoder(output), lengths
+
+    def greedy_decode_batch(self, x, xlen=None, max_symbols=5):
+        '''
+        Greedy decoding of the whole batch at once. The encoder outputs are projected once, then every frame emits
+        the best label while it is not blank, up to `max_symbols` labels, and the prediction network is stepped for
+        the utterances that emitted only.
+        `xlen`: number of valid frames of every utterance, frames beyond are not decoded
+        returns the label sequences
+        '''
         with torch.no_grad():
-            for ind in range(output.size(0)):
-                x = output[ind]
-                vy = autograd.Variable(torch.LongTensor([0])).view(1, 1)  # vector preserve for embedding
-                if x.is_cuda:
-                    vy = vy.cuda()
-                _, y, h = self.decoder(y_mat=vy)
-                y_seq = [];
-                logp = 0
-
-                for i in x:
-                    ytu = self.joint(i, y[0][0])
-                    out = F.log_softmax(ytu, dim=0)
-                    p, pred = torch.max(out, dim=0)
-                    pred = int(pred);
-                    logp += float(p)
-                    if pred != self.blank:
-                        y_seq.append(pred)
-                        vy.data[0][0] = pred
-                        _, y, h = self.decoder(y_mat=vy, hid=h)
-
-                decoded.append(y_seq)
+            f, lengths = self.encode(x, xlen)
+            batch_size, frames = f.size(0), f.size(1)
+
+            labels = torch.full((batch_size, 1), self.blank, dtype=torch.long, device=f.device)
+            _, g, (h, c) = self.decoder(y_mat=labels)
+            g = self.project_decoder(g[:, 0])
+
+            decoded = [[] for _ in range(batch_size)]
+            for t in range(frames):
+                rows = (lengths > t).nonzero().view(-1)
+                for _ in range(max_symbols):
+                    if rows.numel() == 0:
+                        break
+                    pred = self.joint(f[rows, t], g[rows], projected=True).argmax(dim=1)
+                    emitted = pred != self.blank
+                    rows, pred = rows[emitted], pred[emitted]
+                    if rows.numel() == 0:
+                        break
+                    for row, label in zip(rows.tolist(), pred.tolist()):
+                        decoded[row].append(label)
+                    _, g_rows, (h_rows, c_rows) = self.decoder(y_mat=pred.view(-1, 1),
+                                                               hid=(h[:, rows].contiguous(), c[:, rows].contiguous()))
+                    g[rows] = self.project_decoder(g_rows[:, 0])
+                    h[:, rows] = h_rows
+                    c[:, rows] = c_rows
         return decoded
 
-    def beam_search(self, xs, labels_map, W=10, prefix=False):
-        '''''
-        `xs`: acoustic model outputs
-        NOTE only support one sequence (batch size = 1)
-        '''''
-        use_gpu = xs.is_cuda
-
-        def forward_step(label, hidden):
-            ''' `label`: int '''
-            label = autograd.Variable(torch.LongTensor([label]), volatile=True).view(1, 1)
-            if use_gpu: label = label.cuda()
-            label = self.embed(label)
-            pred, hidden = self.decoder(label, hidden)
-            return pred[0][0], hidden
-
-        def isprefix(a, b):
-            # a is the prefix of b
-            if a == b or len(a) >= len(b): return False
-            for i in range(len(a)):
-                if a[i] != b[i]: return False
-            return True
-
-        xs = self.encoder(xs)[0][0]
-        B = [Sequence(labels_map=labels_map, blank=self.blank)]
-        for i, x in enumerate(xs):
-            sorted(B, key=lambda a: len(a.k), reverse=True)  # larger sequence first add
-            A = B
-            B = []
-            if prefix:
-                # for y in A:
-                #     y.logp = log_aplusb(y.logp, prefixsum(y, A, x))
-                for j in range(len(A) - 1):
-                    for i in range(j + 1, len(A)):
-                        if not isprefix(A[i].k, A[j].k): continue
-                        # A[i] -> A[j]
-                        pred, _ = forward_step(A[i].k[-1], A[i].h)
-                        idx = len(A[i].k)
-                        ytu = self.joint(x, pred)
-                        logp = F.log_softmax(ytu, dim=0)
-                        curlogp = A[i].logp + float(logp[A[j].k[idx]])
-                        for k in range(idx, len(A[j].k) - 1):
-                            ytu = self.joint(x, A[j].g[k])
-                            logp = F.log_softmax(ytu, dim=0)
-                            curlogp += float(logp[A[j].k[k + 1]])
-                        A[j].logp = log_aplusb(A[j].logp, curlogp)
-
-            while True:
-                y_hat = max(A, key=lambda a: a.logp)
-                # y* = most probable in A
-                A.remove(y_hat)
-                # calculate P(k|y_hat, t)
-                # get last label and hidden state
-                pred, hidden = forward_step(y_hat.k[-1], y_hat.h)
-                ytu = self.joint(x, pred)
-                logp = F.log_softmax(ytu, dim=0)  # log probability for each k
-                # TODO only use topk vocab
-                for k in range(self.vocab_size):
-                    yk = Sequence(y_hat)
-                    yk.logp += float(logp[k])
-                    if k == self.blank:
-                        B.append(yk)  # next move
-                        continue
-                    # store prediction distribution and last hidden state
-                    # yk.h.append(hidden); yk.k.append(k)
-                    yk.h = hidden;
-                    yk.k.append(k);
-                    if prefix: yk.g.append(pred)
-                    A.append(yk)
-                # sort A
-                # sorted(A, key=lambda a: a.logp, reverse=True) # just need to calculate maximum seq
-
-                # sort B
-                # sorted(B, key=lambda a: a.logp, reverse=True)
-                y_hat = max(A, key=lambda a: a.logp)
-                yb = max(B, key=lambda a: a.logp)
-                if len(B) >= W and yb.logp >= y_hat.logp: break
-
-            # beam width
-            sorted(B, key=lambda a: a.logp, reverse=True)
-            B = B[:W]
-
-        # return highest probability sequence
-        print(B[0])
-        return B[0].k, -B[0].logp
+    def beam_search(self, xs, xlen=None, beam=4, schedule='time', max_symbols=None, cache=None):
+        '''
+        Beam search of the whole batch at once, the `beam` hypotheses of every utterance are rows of the same tensors.
+        Every expansion keeps the `beam` most probable labels of each hypothesis, then the `beam` best extensions of
+        each utterance, and extensions with the same labels are merged by adding their probabilities (log_aplusb).
+        `xlen`: number of valid frames of every utterance, frames beyond are not decoded
+        `schedule`: 'time' advances every hypothesis by one frame per step and emits at most one label per frame
+        (modified beam search), 'alsd' advances every hypothesis by one frame or one label per step (alignment-length
+        synchronous decoding), so utterances can have more labels than encoder frames
+        `max_symbols`: labels of a hypothesis at most with 'alsd', the number of frames of its utterance by default
+        `cache`: optional DecoderStateCache, the prediction network only runs for the label prefixes it misses
+        returns the label sequences and their negative log-likelihoods
+        '''
+        if schedule not in ('time', 'alsd'):
+            raise ValueError('Invalid schedule %s' % schedule)
+        with torch.no_grad():
+            f, lengths = self.encode(xs, xlen)
+            batch_size, frames = f.size(0), f.size(1)
+
+            # row b * beam + k holds hypothesis k of utterance b, only the first one is alive at the start
+            labels = torch.full((batch_size * beam, 1), self.blank, dtype=torch.long, device=f.device)
+            _, g, hid = self.decoder(y_mat=labels)
+            g = self.project_decoder(g[:, 0])
+            scores = torch.full((batch_size, beam), -math.inf, device=f.device)
+            scores[:, 0] = 0
+            hyps = [()] * (batch_size * beam)
+
+            if schedule == 'time':
+                keep = torch.arange(beam, device=f.device).expand(batch_size, -1)
+                for t in range(frames):
+                    candidates, candidate_labels = self._beam_candidates(f[:, t:t + 1], g, scores, beam)
+                    best, index = candidates.topk(beam, dim=1)
+                    # utterances past their last frame keep their hypotheses
+                    done = (lengths <= t).view(-1, 1)
+                    scores = torch.where(done, scores, best)
+                    source = torch.where(done, keep, index // (candidates.size(1) // beam))
+                    labels = candidate_labels.gather(1, index).masked_fill(done, self.blank)
+                    hyps, scores, g, hid = self._beam_update(hyps, scores, source, labels, g, hid, cache)
+                finals = [{} for _ in range(batch_size)]
+            else:
+                hyps, scores, finals = self._alsd(f, lengths, hyps, scores, g, hid, beam, max_symbols, cache)
+
+            decoded, nll = [], []
+            for b, (row_scores, final) in enumerate(zip(scores.tolist(), finals)):
+                # hypotheses that did not reach the last frame only count when none did
+                if not final:
+                    k = max(range(beam), key=lambda k: row_scores[k])
+                    final = {hyps[b * beam + k]: row_scores[k]}
+                hyp = max(final, key=final.get)
+                decoded.append(list(hyp))
+                nll.append(-final[hyp])
+        return decoded, nll
+
+    def _alsd(self, f, lengths, hyps, scores, g, hid, beam, max_symbols, cache=None):
+        # a hypothesis with u labels is at frame i - u at step i, blank at its last frame ends it in `finals`
+        batch_size, frames = f.size(0), f.size(1)
+        finals = [{} for _ in range(batch_size)]
+        best_final = torch.full((batch_size, 1), -math.inf, device=f.device)
+        max_symbols = lengths.view(-1, 1) if max_symbols is None else torch.full_like(lengths.view(-1, 1), max_symbols)
+        for i in range(frames + int(max_symbols.max())):
+            counts = torch.tensor([len(hyp) for hyp in hyps], device=f.device).view(batch_size, beam)
+            t = i - counts
+            scores = scores.masked_fill(t >= lengths.view(-1, 1), -math.inf)
+            f_hyps = f.gather(1, t.clamp(max=frames - 1).unsqueeze(2).expand(-1, -1, f.size(2)))
+            candidates, candidate_labels = self._beam_candidates(f_hyps, g, scores, beam, counts < max_symbols)
+            per_hyp = candidates.size(1) // beam
+            ends = (candidate_labels == self.blank) & (t == lengths.view(-1, 1) - 1).repeat_interleave(per_hyp, 1) \
+                & (candidates > -math.inf)
+            for b, j in ends.nonzero().tolist():
+                hyp, score = hyps[b * beam + j // per_hyp], candidates[b, j].item()
+                finals[b][hyp] = log_aplusb(finals[b][hyp], score) if hyp in finals[b] else score
+                best_final[b] = max(best_final[b].item(), finals[b][hyp])
+            candidates = candidates.masked_fill(ends, -math.inf)
+
+            scores, index = candidates.topk(beam, dim=1)
+            labels = candidate_labels.gather(1, index)
+            hyps, scores, g, hid = self._beam_update(hyps, scores, index // per_hyp, labels, g, hid, cache)
+            # scores only decrease, hypotheses already below the best ended one are dropped
+            scores = scores.masked_fill(scores <= best_final, -math.inf)
+            if (scores == -math.inf).all():
+                break
+        return hyps, scores, finals
+
+    def _beam_candidates(self, f, g, scores, beam, emit=None):
+        '''
+        `f`: projected encoder outputs, (B, 1, H) shared by the hypotheses of an utterance or (B, beam, H)
+        `g`: projected prediction network outputs of the hypotheses, (B * beam, H)
+        `scores`: log-likelihoods of the hypotheses, (B, beam), -inf for dead ones
+        `emit`: optional (B, beam) mask of the hypotheses that may emit a label, the others only extend with blank
+        returns the log-likelihoods and labels of the `beam` best extensions of each hypothesis, (B, beam * beam)
+        '''
+        batch_size = scores.size(0)
+        logp = F.log_softmax(self.joint(f, g.view(batch_size, beam, -1), projected=True), dim=2)
+        if emit is not None:
+            blank = logp[:, :, self.blank].clone()
+            logp = logp.masked_fill(~emit.unsqueeze(2), -math.inf)
+            logp[:, :, self.blank] = blank
+        logp, labels = logp.topk(min(beam, self.vocab_size), dim=2)
+        return (scores.unsqueeze(2) + logp).view(batch_size, -1), labels.view(batch_size, -1)
+
+    def _beam_update(self, hyps, scores, source, labels, g, hid, cache=None):
+        '''
+        Hypothesis k of utterance b becomes hypothesis source[b, k] extended by labels[b, k], with the log-likelihood
+        scores[b, k]. Extensions with the same labels are merged into the first, and the prediction network steps for
+        the extensions that emitted a label, or looks their labels up in `cache`.
+        '''
+        batch_size, beam = scores.shape
+        rows = (source + torch.arange(batch_size, device=source.device).view(-1, 1) * beam).view(-1)
+        g, hid = g[rows], (hid[0][:, rows], hid[1][:, rows])
+        labels = labels.view(-1)
+
+        merged = scores.view(-1).tolist()
+        new_hyps, first = [], {}
+        for row, (source_row, label) in enumerate(zip(rows.tolist(), labels.tolist())):
+            hyp = hyps[source_row] if label == self.blank else hyps[source_row] + (label,)
+            new_hyps.append(hyp)
+            if merged[row] == -math.inf:
+                continue
+            key = (row // beam, hyp)
+            if key in first:
+                merged[first[key]] = log_aplusb(merged[first[key]], merged[row])
+                merged[row] = -math.inf
+            else:
+                first[key] = row
+        scores = torch.tensor(merged, dtype=scores.dtype, device=scores.device)
+
+        step = ((labels != self.blank) & (scores > -math.inf)).nonzero().view(-1)
+        if step.numel() > 0:
+            def compute(index):
+                rows = step[index.to(step.device)]
+                _, g_rows, hid_rows = self.decoder(y_mat=labels[rows].view(-1, 1),
+                                                   hid=(hid[0][:, rows].contiguous(), hid[1][:, rows].contiguous()))
+                return self.project_decoder(g_rows[:, 0]), hid_rows
+
+            if cache is None:
+                g_step, (h_step, c_step) = compute(torch.arange(step.numel()))
+            else:
+                g_step, (h_step, c_step) = cache.lookup([new_hyps[row] for row in step.tolist()], compute)
+            g[step] = g_step
+            hid[0][:, step] = h_step
+            hid[1][:, step] = c_step
+        return new_hyps, scores.view(batch_size, beam), g, hid
 
 
 def log_aplusb(a, b):
     return max(a, b) + math.log1p(math.exp(-math.fabs(a - b)))
 
 
-class Sequence():
-    def __init__(self, labels_map, seq=None, blank=0):
-        if seq is None:
-            self.g = []  # predictions of phoneme language model
-            self.k = [blank]  # prediction phoneme label
-            # self.h = [None] # input hidden vector to phoneme model
-            self.h = None
-            self.logp = 0  # probability of this sequence, in log scale
-        else:
-            self.g = seq.g[:]  # save for prefixsum
-            self.k = seq.k[:]
-            self.h = seq.h
-            self.logp = seq.logp
-        self.labels_map = labels_map
+class DecoderStateCache(object):
+    def __init__(self, capacity=4096):
+        '''
+        LRU cache of prediction network states keyed by label prefix, each entry holds the projected output g and the
+        LSTM state (h, c) after the prefix. The entries live in preallocated tensors of `capacity` rows, so hits are
+        gathered in one indexing. The states only depend on the labels, the cache can be shared by utterances and
+        batches as long as the prediction network does not change.
+        '''
+        self.capacity = capacity
+        self.slots = OrderedDict()
+        self.g = self.h = self.c = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.slots)
+
+    @property
+    def hit_rate(self):
+        return self.hits / float(max(self.hits + self.misses, 1))
+
+    @property
+    def entry_size(self):
+        # bytes of one entry
+        if self.g is None:
+            return 0
+        return sum(tensor[..., 0, :].numel() * tensor.element_size() for tensor in (self.g, self.h, self.c))
+
+    @property
+    def memory(self):
+        # bytes of the entries in use, the preallocated tensors take capacity * entry_size
+        return len(self.slots) * self.entry_size
+
+    def clear(self):
+        self.slots.clear()
+
+    def lookup(self, keys, compute):
+        '''
+        `keys`: label prefixes as tuples
+        `compute`: function of a LongTensor of indices into `keys`, returns the states of those keys in one batch as
+        g (N, H) and (h, c) (layers, N, H), it is called once with the keys that are missing
+        returns the states of all keys, g and (h, c)
+        '''
+        hit_index, hit_slots, missing = [], [], OrderedDict()
+        for i, key in enumerate(keys):
+            slot = self.slots.get(key)
+            if slot is None:
+                missing.setdefault(key, []).append(i)
+            else:
+                self.slots.move_to_end(key)
+                hit_index.append(i)
+                hit_slots.append(slot)
+        self.hits += len(hit_index)
+        self.misses += len(keys) - len(hit_index)
+
+        # a repeated missing key is computed once
+        first = [index[0] for index in missing.values()]
+        if first:
+            g_new, (h_new, c_new) = compute(torch.tensor(first, dtype=torch.long))
+            if self.g is None:
+                self.g = g_new.new_empty((self.capacity,) + g_new.shape[1:])
+                self.h = h_new.new_empty((h_new.size(0), self.capacity) + h_new.shape[2:])
+                self.c = c_new.new_empty((c_new.size(0), self.capacity) + c_new.shape[2:])
+        g = self.g.new_empty((len(keys),) + self.g.shape[1:])
+        h = self.h.new_empty((self.h.size(0), len(keys)) + self.h.shape[2:])
+        c = self.c.new_empty((self.c.size(0), len(keys)) + self.c.shape[2:])
+
+        # hits are read before misses are stored, storing can evict them
+        if hit_index:
+            hit_index = torch.tensor(hit_index, dtype=torch.long, device=g.device)
+            hit_slots = torch.tensor(hit_slots, dtype=torch.long, device=g.device)
+            g[hit_index] = self.g[hit_slots]
+            h[:, hit_index] = self.h[:, hit_slots]
+            c[:, hit_index] = self.c[:, hit_slots]
+        if first:
+            repeats = torch.tensor([len(index) for index in missing.values()], device=g.device)
+            index = torch.tensor([i for index in missing.values() for i in index], dtype=torch.long, device=g.device)
+            g[index] = g_new.repeat_interleave(repeats, dim=0)
+            h[:, index] = h_new.repeat_interleave(repeats, dim=1)
+            c[:, index] = c_new.repeat_interleave(repeats, dim=1)
+            # only the last `capacity` of more missing keys fit
+            skip = max(len(first) - self.capacity, 0)
+            self.store(list(missing)[skip:], g_new[skip:], h_new[:, skip:], c_new[:, skip:])
+        return g, (h, c)
+
+    def store(self, keys, g, h, c):
+        slots = []
+        for key in keys:
+            if len(self.slots) < self.capacity:
+                slot = len(self.slots)
+            else:
+                _, slot = self.slots.popitem(last=False)
+                self.evictions += 1
+            self.slots[key] = slot
+            slots.append(slot)
+        slots = torch.tensor(slots, dtype=torch.long, device=g.device)
+        self.g[slots] = g
+        self.h[:, slots] = h
+        self.c[:, slots] = c
 
     def __str__(self):
-        return 'Prediction: {}\nlog-likelihood {:.2f}\n'.format(' '.join([self.labels_map[i] for i in self.k]), -self.logp)
+        return 'entries %d/%d (%.1f MB), hits %d, misses %d, hit rate %.1f%%, evictions %d' % (
+            len(self), self.capacity, self.memory / 2 ** 20, self.hits, self.misses, 100 * self.hit_rate,
+            self.evictions)
 
 
 class Attention(nn.Module):
@@ -0,0 +1,299 @@
+import torch
+import torch.nn.functional as F
+from torch import nn, autograd
+from torch.utils.checkpoint import checkpoint
+
+
+def _diagonal(n, T, U1, device):
+    # cells (t, u) of the T x U1 lattice with t + u == n
+    t = torch.arange(max(0, n - U1 + 1), min(n, T - 1) + 1, device=device)
+    return t, n - t
+
+
+def _pad_labels(labels, label_lens):
+    # Transducer used to pass the labels flattened for the CPU binding of warp-transducer
+    if labels.dim() == 2:
+        return labels
+    rows = torch.split(labels, label_lens.tolist())
+    padded = labels.new_zeros(len(rows), max(int(label_lens.max()), 1))
+    for row, label in zip(padded, rows):
+        row[:label.size(0)] = label
+    return padded
+
+
+def _transitions(log_probs, labels, blank):
+    # log probabilities of the blank and label transitions of every lattice cell, and the index of the labels
+    B, T, U1, _ = log_probs.shape
+    labels = labels[:, :U1 - 1].long()
+    index = labels.view(B, 1, U1 - 1, 1).expand(B, T, U1 - 1, 1)
+    blanks = log_probs[..., blank]
+    emits = F.pad(log_probs[:, :, :-1].gather(3, index).squeeze(3), (0, 1), value=float('-inf'))
+    return blanks, emits, index
+
+
+def _mask(blanks, emits, act_lens, label_lens):
+    '''
+    Sets label transitions at u >= U and blank transitions at t >= T - 1 to -inf, except for the final blank, which is
+    marked in the returned `terminal` mask.
+    '''
+    B, T, U1 = blanks.shape
+    t = torch.arange(T, device=blanks.device).view(1, T, 1)
+    u = torch.arange(U1, device=blanks.device).view(1, 1, U1)
+    act_lens = act_lens.to(blanks.device).long().view(B, 1, 1)
+    label_lens = label_lens.to(blanks.device).long().view(B, 1, 1)
+    terminal = (t == act_lens - 1) & (u == label_lens)
+    blanks = blanks.masked_fill((t >= act_lens - 1) & ~terminal, float('-inf'))
+    emits = emits.masked_fill(u >= label_lens, float('-inf'))
+    return blanks, emits, terminal
+
+
+def _alphas(blanks, emits):
+    # alpha(t, u) is kept at [t + 1, u + 1], so the first row and column read -inf
+    B, T, U1 = blanks.shape
+    alphas = blanks.new_full((B, T + 1, U1 + 1), float('-inf'))
+    alphas[:, 1, 1] = 0
+    blanks = F.pad(blanks, (1, 0, 1, 0), value=float('-inf'))
+    emits = F.pad(emits, (1, 0, 1, 0), value=float('-inf'))
+    for n in range(1, T + U1 - 1):
+        t, u = _diagonal(n, T, U1, blanks.device)
+        t, u = t + 1, u + 1
+        alphas[:, t, u] = torch.logaddexp(alphas[:, t - 1, u] + blanks[:, t - 1, u],
+                                          alphas[:, t, u - 1] + emits[:, t, u - 1])
+    return alphas[:, 1:, 1:]
+
+
+def _betas(blanks, emits, terminal):
+    # beta(t, u) is kept at [t, u], the last row and column read -inf
+    B, T, U1 = blanks.shape
+    betas = blanks.new_full((B, T + 1, U1 + 1), float('-inf'))
+    for n in range(T + U1 - 2, -1, -1):
+        t, u = _diagonal(n, T, U1, blanks.device)
+        values = torch.logaddexp(betas[:, t + 1, u] + blanks[:, t, u],
+                                 betas[:, t, u + 1] + emits[:, t, u])
+        betas[:, t, u] = torch.where(terminal[:, t, u], blanks[:, t, u], values)
+    return betas[:, :T, :U1]
+
+
+def _posteriors(blanks, emits, terminal):
+    '''
+    Forward-backward over the masked lattice. Returns the log likelihoods, the occupancies of the cells and the
+    posteriors of the blank and label transitions, which are minus the gradient of the cost with respect to them.
+    '''
+    alphas = _alphas(blanks, emits)
+    betas = _betas(blanks, emits, terminal)
+    log_like = betas[:, 0, 0].view(-1, 1, 1)
+    # next cell of the blank and label transitions, the final blank leaves the lattice with probability 1
+    next_t = F.pad(betas[:, 1:], (0, 0, 0, 1), value=float('-inf')).masked_fill(terminal, 0)
+    next_u = F.pad(betas[:, :, 1:], (0, 1), value=float('-inf'))
+    blank_posteriors = torch.exp(alphas + blanks + next_t - log_like)
+    emit_posteriors = torch.exp(alphas + emits + next_u - log_like)
+    occupancy = torch.exp(alphas + betas - log_like)
+    return log_like.view(-1), occupancy, blank_posteriors, emit_posteriors
+
+
+class _RNNTLoss(autograd.Function):
+    @staticmethod
+    def forward(ctx, acts, labels, act_lens, label_lens, blank):
+        '''
+        Costs of every utterance. The gradient is computed here together with the costs, like warp-transducer does,
+        so only the (B, T, U + 1, V) gradient is kept for backward.
+        '''
+        with torch.no_grad():
+            log_probs = F.log_softmax(acts, dim=3)
+            blanks, emits, index = _transitions(log_probs, labels, blank)
+            blanks, emits, terminal = _mask(blanks, emits, act_lens, label_lens)
+            if not ctx.needs_input_grad[0]:
+                return -_betas(blanks, emits, terminal)[:, 0, 0]
+            log_like, occupancy, blank_posteriors, emit_posteriors = _posteriors(blanks, emits, terminal)
+
+            # through the log_softmax: softmax times the occupancy of the cell, minus the used transitions
+            grads = log_probs.exp_().mul_(occupancy.unsqueeze(3))
+            grads[..., blank] -= blank_posteriors
+            grads[:, :, :-1].scatter_add_(3, index, -emit_posteriors[:, :, :-1].unsqueeze(3))
+        ctx.grads = grads
+        return -log_like
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grads = ctx.grads * grad_output.view(-1, 1, 1, 1).to(ctx.grads.dtype)
+        return grads, None, None, None, None
+
+
+class _LatticeLoss(autograd.Function):
+    @staticmethod
+    def forward(ctx, blanks, emits, act_lens, label_lens):
+        '''
+        Costs of every utterance from the (B, T, U + 1) log probabilities of the blank and label transitions alone,
+        and the occupancies of the cells.
+        '''
+        with torch.no_grad():
+            blanks, emits, terminal = _mask(blanks, emits, act_lens, label_lens)
+            log_like, occupancy, blank_posteriors, emit_posteriors = _posteriors(blanks, emits, terminal)
+        ctx.save_for_backward(blank_posteriors, emit_posteriors)
+        ctx.mark_non_differentiable(occupancy)
+        return -log_like, occupancy
+
+    @staticmethod
+    def backward(ctx, grad_output, _):
+        blank_posteriors, emit_posteriors = ctx.saved_tensors
+        grad_output = -grad_output.view(-1, 1, 1).to(blank_posteriors.dtype)
+        return blank_posteriors * grad_output, emit_posteriors * grad_output, None, None
+
+
+def _reduce(costs, reduction):
+    if reduction == 'mean':
+        return costs.sum() / costs.size(0)
+    if reduction == 'sum':
+        return costs.sum()
+    return costs
+
+
+def rnnt_loss(acts, labels, act_lens, label_lens, blank=0, reduction='mean'):
+    '''
+    RNN-T loss in plain PyTorch. The forward-backward recursion runs along the anti-diagonals of the T x U lattice,
+    every diagonal being one batched step over all cells and utterances, so it works on any device and needs no
+    compiled extension. Matches warp-transducer's RNNTLoss.
+    `acts`: (batch, T, U + 1, vocab) unnormalized joint outputs, log_softmax is applied here
+    `labels`: (batch, U) padded labels, or the labels of all utterances concatenated
+    `act_lens`, `label_lens`: (batch,) number of valid frames and labels
+    `reduction`: 'mean' (sum over the batch divided by the batch size, like warp-transducer), 'sum' or 'none'
+    '''
+    if reduction not in ('mean', 'sum', 'none'):
+        raise ValueError('Invalid reduction %s' % reduction)
+    costs = _RNNTLoss.apply(acts, _pad_labels(labels, label_lens), act_lens, label_lens, blank)
+    return _reduce(costs, reduction)
+
+
+def _chunk_transitions(joint, f, g, labels, blank):
+    blanks, emits, _ = _transitions(F.log_softmax(joint(f, g), dim=3), labels, blank)
+    return blanks, emits
+
+
+def chunked_rnnt_loss(joint, f, g, labels, act_lens, label_lens, vocab_size, blank=0, max_elements=2 ** 24,
+                      reduction='mean'):
+    '''
+    RNN-T loss fused with the joint network, which bounds the memory of the (B, T, U + 1, V) logits. The joint,
+    log_softmax and gather of the transitions run on chunks of frames of the whole batch, only the (B, T, U + 1)
+    blank and label log probabilities are kept for the lattice recursion. The chunks are checkpointed, their joint
+    activations are recomputed in backward (with the same dropout masks).
+    `joint`: maps f (B, frames, 1, H) and g (B, 1, U + 1, H) to the logits (B, frames, U + 1, V)
+    `f`, `g`: (B, T, 1, H) and (B, 1, U + 1, H) inputs of the joint
+    `max_elements`: logits of at most this many elements per chunk (at least one frame), lower values trade memory
+    for more, smaller kernels
+    '''
+    if reduction not in ('mean', 'sum', 'none'):
+        raise ValueError('Invalid reduction %s' % reduction)
+    B, T, U1 = f.size(0), f.size(1), g.size(2)
+    labels = _pad_labels(labels, label_lens)
+    frames = max(1, max_elements // (B * U1 * vocab_size))
+    chunks = []
+    for start in range(0, T, frames):
+        chunk = f[:, start:start + frames]
+        if torch.is_grad_enabled():
+            chunks.append(checkpoint(_chunk_transitions, joint, chunk, g, labels, blank, use_reentrant=False))
+        else:
+            chunks.append(_chunk_transitions(joint, chunk, g, labels, blank))
+    blanks = torch.cat([blanks for blanks, _ in chunks], dim=1)
+    emits = torch.cat([emits for _, emits in chunks], dim=1)
+    return _reduce(_LatticeLoss.apply(blanks, emits, act_lens, label_lens)[0], reduction)
+
+
+def simple_rnnt_loss(am, lm, labels, act_lens, label_lens, blank=0, reduction='mean'):
+    '''
+    RNN-T loss of the additive joint am[t] + lm[u], used to find the bands of the pruned loss. The log_softmax
+    normalizers of all cells are one batched matmul of exponentials, no (B, T, U + 1, V) tensor is formed.
+    `am`: (B, T, V) encoder logits
+    `lm`: (B, U + 1, V) prediction network logits
+    returns the costs and the (B, T, U + 1) occupancies of the cells
+    '''
+    if reduction not in ('mean', 'sum', 'none'):
+        raise ValueError('Invalid reduction %s' % reduction)
+    B, T, U1 = am.size(0), am.size(1), lm.size(1)
+    labels = _pad_labels(labels, label_lens)[:, :U1 - 1].long()
+    am_max = am.detach().max(dim=2, keepdim=True)[0]
+    lm_max = lm.detach().max(dim=2, keepdim=True)[0]
+    normalizers = torch.log(torch.matmul(torch.exp(am - am_max), torch.exp(lm - lm_max).transpose(1, 2)))
+    normalizers = normalizers + am_max + lm_max.transpose(1, 2)
+
+    blanks = am[..., blank].unsqueeze(2) + lm[..., blank].unsqueeze(1) - normalizers
+    emits = am.gather(2, labels.unsqueeze(1).expand(B, T, U1 - 1)) + lm[:, :-1].gather(2, labels.unsqueeze(2)).view(
+        B, 1, U1 - 1)
+    emits = F.pad(emits - normalizers[:, :, :-1], (0, 1), value=float('-inf'))
+    costs, occupancy = _LatticeLoss.apply(blanks, emits, act_lens, label_lens)
+    return _reduce(costs, reduction), occupancy
+
+
+def prune_ranges(occupancy, act_lens, label_lens, prune_range):
+    '''
+    First label position of the `prune_range` positions kept at every frame, (B, T). Each frame keeps the window
+    with the largest occupancy. The first frame starts at 0 and the last frame of every utterance reaches its last
+    label. Starts never decrease and grow by at most prune_range - 1 between frames, so every kept band is
+    connected to the next one.
+    returns the starts and the range actually used: it is widened for utterances with more labels than
+    (prune_range - 1) per frame, which could not reach their last label otherwise
+    '''
+    B, T, U1 = occupancy.shape
+    act_lens, label_lens = act_lens.to(occupancy.device).long(), label_lens.to(occupancy.device).long()
+    needed = int(((label_lens + act_lens - 1) // act_lens.clamp(min=1)).max()) + 1
+    prune_range = min(max(prune_range, needed), U1)
+    sums = F.pad(occupancy.cumsum(2), (1, 0))
+    starts = (sums[:, :, prune_range:] - sums[:, :, :-prune_range]).argmax(2)
+
+    t = torch.arange(T, device=occupancy.device)
+    last = (label_lens + 1 - prune_range).clamp(min=0).view(B, 1)
+    starts = torch.min(starts, last)
+    starts[:, 0] = 0
+    # lower later starts until no step from an earlier frame is larger than prune_range - 1 and make them
+    # non-decreasing, then raise earlier starts until the last label is reached in steps of prune_range - 1
+    offsets = t * (prune_range - 1)
+    starts = ((starts - offsets).cummin(1)[0] + offsets).cummax(1)[0]
+    starts = torch.where(t >= act_lens.view(B, 1) - 1, last, starts)
+    return (starts - offsets).flip(1).cummax(1)[0].flip(1) + offsets, prune_range
+
+
+def pruned_rnnt_loss(joint, f, g, labels, act_lens, label_lens, starts, prune_range, blank=0, reduction='mean'):
+    '''
+    RNN-T loss with the joint evaluated only on `prune_range` label positions per frame, from `starts`
+    (prune_ranges) and the range returned with them. The logits are (B, T, prune_range, V) instead of (B, T, U + 1, V), the cells outside the bands
+    are unreachable.
+    `joint`: maps f (B, T, 1, H) and g (B, T, prune_range, H) to logits
+    `f`, `g`: (B, T, H) and (B, U + 1, H) inputs of the joint
+    '''
+    if reduction not in ('mean', 'sum', 'none'):
+        raise ValueError('Invalid reduction %s' % reduction)
+    B, T, U1, H = f.size(0), f.size(1), g.size(1), g.size(2)
+    index = starts.unsqueeze(2) + torch.arange(prune_range, device=starts.device)
+    g = g.gather(1, index.view(B, T * prune_range, 1).expand(B, T * prune_range, H)).view(B, T, prune_range, H)
+    log_probs = F.log_softmax(joint(f.unsqueeze(2), g), dim=3)
+
+    # label emitted from position u is labels[u], the one past the last label is masked in the lattice
+    labels = F.pad(_pad_labels(labels, label_lens)[:, :U1 - 1].long(), (0, 1))
+    label_index = labels.gather(1, index.view(B, T * prune_range)).view(B, T, prune_range, 1)
+    lattice = log_probs.new_full((B, T, U1), float('-inf'))
+    blanks = lattice.scatter(2, index, log_probs[..., blank])
+    emits = lattice.scatter(2, index, log_probs.gather(3, label_index).squeeze(3))
+    return _reduce(_LatticeLoss.apply(blanks, emits, act_lens, label_lens)[0], reduction)
+
+
+def pruned_loss_scales(step, warmup_steps, simple_scale=0.5):
+    '''
+    Weights of the simple and the pruned loss at training step `step`. During warm-up the simple loss goes from 1 to
+    `simple_scale` and the pruned loss, whose bands are poor while the simple joint is untrained, from 0.1 to 1.
+    '''
+    if step is None or step >= warmup_steps:
+        return simple_scale, 1.
+    progress = step / float(warmup_steps)
+    return 1. - progress * (1. - simple_scale), .1 + .9 * progress
+
+
+class RNNTLoss(nn.Module):
+    def __init__(self, blank=0, reduction='mean'):
+        '''
+        Drop-in replacement of warprnnt_pytorch.RNNTLoss, see rnnt_loss.
+        '''
+        super(RNNTLoss, self).__init__()
+        self.blank = blank
+        self.reduction = reduction
+
+    def forward(self, acts, labels, act_lens, label_lens):
+        return rnnt_loss(acts, labels, act_lens, label_lens, blank=self.blank, reduction=self.reduction)
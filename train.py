@@ -1,12 +1,14 @@
 
 #!python
-from models.models import Transducer
-from data.data_loader import AudioDataLoader, SpectrogramDataset, BucketingSampler, DistributedBucketingSampler
+from models.models import Transducer, DecoderStateCache
+from models.frontend import SpectrogramFrontend, GlobalCMVN, StreamingCMVN
+from data.cmvn import CMVNStats
+from data.manifest_index import load_labels
+from data.data_loader import AudioDataLoader, SpectrogramDataset, PackedSpectrogramDataset, BucketingSampler, \
+    DistributedBucketingSampler, FrameBudgetSampler, DistributedFrameBudgetSampler, spec_augment
 import argparse
-import json
 import os
 import time
-import codecs
 import torch
 torch.cuda.empty_cache()
 import torch.distributed as dist
@@ -22,6 +24,14 @@ parser.add_argument('--val-manifest', metavar='DIR',
                     help='path to validation manifest csv', default='data/val_manifest.csv')
 parser.add_argument('--sample-rate', default=16000, type=int, help='Sample rate')
 parser.add_argument('--batch-size', default=10, type=int, help='Batch size for training')
+parser.add_argument('--frame-budget', default=None, type=int,
+                    help='Pack training batches up to this many padded frames instead of a fixed batch size')
+parser.add_argument('--budget-mode', default='frames', choices=['frames', 'joint'],
+                    help='Budget padded spectrogram frames or the frames x labels lattice of the RNN-T loss')
+parser.add_argument('--balance', default=None, choices=['frames', 'joint'],
+                    help='Distributed training: split every step between ranks by total frames or frames x labels')
+parser.add_argument('--balance-strategy', default='lpt', choices=['lpt', 'greedy'],
+                    help='Assign the longest utterances first (lpt) or in shuffled order (greedy)')
 parser.add_argument('--dropout', default=0.2, type=float, help='Dropout size for training')
 parser.add_argument('--decoder-num-layers', default=2, type=float, help='number of layer at RNN-T model')
 parser.add_argument('--encoder-num-layers', default=3, type=float, help='number of layer at RNN-T model')
@@ -37,8 +47,15 @@ parser.add_argument('--lr', '--learning-rate', default=1e-3, type=float, help='i
 parser.add_argument('--log-dir', default='logs/', help='Location of tensorboard log')
 parser.add_argument('--model-path', default=None, help='Location to save best validation model')
 parser.add_argument('--augment', dest='augment', action='store_true', help='Use random tempo and gain perturbations.')
+parser.add_argument('--augment-backend', default='native', choices=['native', 'sox'],
+                    help='Apply augmentation in-process or with a sox subprocess per sample')
+parser.add_argument('--speed-min', default=None, type=float,
+                    help='Adds resampling based speed perturbation from speed-min to speed-max (native backend)')
+parser.add_argument('--speed-max', default=None, type=float)
 parser.add_argument('--noise-dir', default=None,
                     help='Directory to inject noise into audio. If default, noise Inject not added')
+parser.add_argument('--noise-cache-dir', default=None,
+                    help='Writable directory of the decoded noise recordings, defaults to ~/.cache/noise_bank')
 parser.add_argument('--noise-prob', default=0.4, help='Probability of noise being added per sample')
 parser.add_argument('--noise-min', default=0.0,
                     help='Minimum noise level to sample from. (1.0 means all noise, not original signal)', type=float)
@@ -53,9 +70,46 @@ parser.add_argument('--rank', default=0, type=int,
                     help='The rank of this process')
 parser.add_argument('--gpu-rank', default=None,
                     help='If using distributed parallel for multi-gpu, sets the GPU for the process')
+parser.add_argument('--feature-cache', default=None,
+                    help='Directory of precomputed features (data/feature_cache.py), used when augmentation is off')
+parser.add_argument('--manifest-index', dest='manifest_index', action='store_true',
+                    help='Read manifests through memory-mapped indexes (data/manifest_index.py) built next to them')
+parser.add_argument('--packed', dest='packed', action='store_true',
+                    help='Train and val manifests are directories of shards packed by data/audio_shards.py')
+parser.add_argument('--batch-features', dest='batch_features', action='store_true',
+                    help='Workers load raw audio and spectrograms are computed on the batch by SpectrogramFrontend')
+parser.add_argument('--pin-memory', dest='pin_memory', action='store_true',
+                    help='Collate batches in page-locked memory and copy them to the GPU asynchronously')
+parser.add_argument('--collate-buffers', default=0, type=int,
+                    help='Reuse a ring of this many preallocated batch buffers per loader worker, 0 allocates every batch')
+parser.add_argument('--prefetch', default=0, type=int,
+                    help='Keep this many batches loaded ahead on a background thread, copied to the GPU on a side stream')
+parser.add_argument('--cmvn-stats', default=None,
+                    help='Normalize features with global statistics from data/cmvn.py instead of per utterance')
+parser.add_argument('--cmvn-window', default=0, type=int,
+                    help='With --cmvn-stats, normalize with the statistics of the last cmvn-window frames (streaming)')
+parser.add_argument('--loss', default='auto', choices=['auto', 'builtin', 'warp'],
+                    help='RNN-T loss: PyTorch (builtin), warp-transducer (warp), or warp-transducer on CUDA when installed')
+parser.add_argument('--joint-chunk', default=None, type=int,
+                    help='Compute joint and loss in chunks of at most this many logits, recomputed in backward')
+parser.add_argument('--prune-range', default=None, type=int,
+                    help='Train with the pruned RNN-T loss, evaluating the joint on this many labels per frame')
+parser.add_argument('--prune-warmup', default=3000, type=int,
+                    help='Steps over which the pruned loss is phased in while the additive joint learns the bands')
+parser.add_argument('--simple-loss-scale', default=0.5, type=float,
+                    help='Weight of the additive joint loss added to the pruned loss after warm-up')
+parser.add_argument('--time-reduction', default=1, type=int, choices=[1, 2, 4, 8],
+                    help='Stack pairs of frames after the first encoder layers to cut the frame rate by this factor')
+parser.add_argument('--conv-subsampling', dest='conv_subsampling', action='store_true',
+                    help='Subsample the features 4x with strided convolutions before the encoder LSTMs')
 parser.add_argument('--spec-augment', dest='spec_augment', action='store_true', help='using SpecAugment')
 parser.add_argument('--lm-model', help='path to pretrained decoder pt model file', default=None)
-parser.add_argument('--beam-search', help='decoding method select default is greedy', default=None)
+parser.add_argument('--beam-search', default=None, choices=['time', 'alsd'],
+                    help='Decode by beam search with this schedule instead of greedy decoding')
+parser.add_argument('--beam-size', default=4, type=int, help='Hypotheses kept per utterance by beam search')
+parser.add_argument('--state-cache', default=0, type=int,
+                    help='Cache this many prediction network states by label prefix during beam search, 0 disables')
+parser.add_argument('--max-symbols', default=5, type=int, help='Labels emitted per frame at most by greedy decoding')
 
 # setting seed
 torch.manual_seed(72160258)
@@ -114,45 +168,107 @@ if __name__ == '__main__':
                       window_stride=args.window_stride,
                       window=args.window,
                       noise_dir=args.noise_dir,
+                      noise_cache_dir=args.noise_cache_dir,
                       noise_prob=args.noise_prob,
-                      noise_levels=(args.noise_min, args.noise_max))
+                      noise_levels=(args.noise_min, args.noise_max),
+                      augment_backend=args.augment_backend,
+                      speed_range=(args.speed_min, args.speed_max) if args.speed_min else None)
+
+    # per utterance normalization unless global statistics are applied by the model
+    normalize = args.cmvn_stats is None
 
     # load label file(character map)
-    with codecs.open(args.labels_path, 'r', encoding='utf-8') as label_file:
-        labels = str(''.join(json.load(label_file)))
-
-    train_dataset = SpectrogramDataset(audio_conf=audio_conf,
-                                       manifest_filepath=args.train_manifest,
-                                       labels=labels,
-                                       normalize=True,
-                                       augment=args.augment,
-                                       specaugment=args.spec_augment)
-    test_dataset = SpectrogramDataset(audio_conf=audio_conf,
-                                      manifest_filepath=args.val_manifest,
-                                      labels=labels,
-                                      normalize=True,
-                                      augment=False,
-                                      specaugment=False)
-
-    if not args.distributed:
+    checkpoint = torch.load(args.model_path) if args.model_path else None
+    # models trained before the blank was added have one output per character, label 0 of the file is their blank
+    legacy_labels = checkpoint is not None and checkpoint.vocab_size == len(load_labels(args.labels_path, blank=False))
+    labels = load_labels(args.labels_path, blank=not legacy_labels)
+
+    if args.packed:
+        train_dataset = PackedSpectrogramDataset(audio_conf=audio_conf,
+                                                 shards_path=args.train_manifest,
+                                                 labels=labels,
+                                                 normalize=normalize,
+                                                 augment=args.augment,
+                                                 specaugment=args.spec_augment,
+                                                 raw_audio=args.batch_features,
+                                                 lean=True)
+        test_dataset = PackedSpectrogramDataset(audio_conf=audio_conf,
+                                                shards_path=args.val_manifest,
+                                                labels=labels,
+                                                normalize=normalize,
+                                                augment=False,
+                                                specaugment=False,
+                                                raw_audio=args.batch_features,
+                                                lean=True)
+    else:
+        train_dataset = SpectrogramDataset(audio_conf=audio_conf,
+                                           manifest_filepath=args.train_manifest,
+                                           labels=labels,
+                                           normalize=normalize,
+                                           augment=args.augment,
+                                           specaugment=args.spec_augment,
+                                           feature_cache=args.feature_cache,
+                                           raw_audio=args.batch_features,
+                                           lean=True,
+                                           manifest_index=args.manifest_index)
+        test_dataset = SpectrogramDataset(audio_conf=audio_conf,
+                                          manifest_filepath=args.val_manifest,
+                                          labels=labels,
+                                          normalize=normalize,
+                                          augment=False,
+                                          specaugment=False,
+                                          feature_cache=args.feature_cache,
+                                          raw_audio=args.batch_features,
+                                          lean=True,
+                                          manifest_index=args.manifest_index)
+
+    if args.frame_budget and not args.distributed:
+        train_sampler = FrameBudgetSampler(train_dataset,
+                                           max_frames=args.frame_budget,
+                                           mode=args.budget_mode)
+    elif args.frame_budget:
+        train_sampler = DistributedFrameBudgetSampler(train_dataset,
+                                                      max_frames=args.frame_budget,
+                                                      mode=args.budget_mode,
+                                                      num_replicas=args.world_size,
+                                                      rank=args.rank)
+    elif not args.distributed:
         train_sampler = BucketingSampler(train_dataset,
                                          batch_size=args.batch_size)
     else:
         train_sampler = DistributedBucketingSampler(train_dataset,
                                                     batch_size=args.batch_size,
                                                     num_replicas=args.world_size,
-                                                    rank=args.rank)
+                                                    rank=args.rank,
+                                                    balance=args.balance,
+                                                    strategy=args.balance_strategy)
 
     train_loader = AudioDataLoader(train_dataset,
                                    num_workers=args.num_workers,
-                                   batch_sampler=train_sampler)
+                                   batch_sampler=train_sampler,
+                                   pin_memory=args.pin_memory,
+                                   num_buffers=args.collate_buffers,
+                                   prefetch=args.prefetch,
+                                   device=device)
     test_loader = AudioDataLoader(test_dataset,
                                   batch_size=args.batch_size,
-                                  num_workers=args.num_workers)
+                                  num_workers=args.num_workers,
+                                  pin_memory=args.pin_memory,
+                                  num_buffers=args.collate_buffers,
+                                  prefetch=args.prefetch,
+                                  device=device)
+    labels_map = train_dataset.labels_map
+    inverse_map = dict((v, k) for k, v in labels_map.items())
 
     # ==========================================
     # NETWORK SETTING
     # ==========================================
+    cmvn = None
+    if args.cmvn_stats and args.cmvn_window:
+        cmvn = StreamingCMVN.from_stats(CMVNStats.load(args.cmvn_stats), window=args.cmvn_window)
+    elif args.cmvn_stats:
+        cmvn = GlobalCMVN.from_stats(CMVNStats.load(args.cmvn_stats))
+
     model = Transducer(input_size=161,
                        vocab_size=len(labels),
                        hidden_size=args.hidden_size,
@@ -160,11 +276,26 @@ if __name__ == '__main__':
                        encoder_num_layers=args.encoder_num_layers,
                        dropout=args.dropout,
                        bidirectional=True,
-                       LM_model_path=args.lm_model).to(device)
-
-    if args.model_path:
-        test = torch.load(args.model_path)
-        model = torch.load(args.model_path)
+                       LM_model_path=args.lm_model,
+                       cmvn=cmvn,
+                       loss=args.loss,
+                       joint_chunk=args.joint_chunk,
+                       prune_range=args.prune_range,
+                       prune_warmup=args.prune_warmup,
+                       simple_loss_scale=args.simple_loss_scale,
+                       time_reduction=args.time_reduction,
+                       conv_subsampling=args.conv_subsampling).to(device)
+
+    frontend = None
+    if args.batch_features:
+        frontend = SpectrogramFrontend(sample_rate=args.sample_rate,
+                                       window_size=args.window_size,
+                                       window_stride=args.window_stride,
+                                       window=args.window,
+                                       normalize=normalize).to(device)
+
+    if checkpoint is not None:
+        model = checkpoint
 
     optimizer = torch.optim.SGD(filter(lambda p: p.requires_grad, model.parameters()),
                                 lr=args.lr, momentum=.9)
@@ -175,33 +306,43 @@ if __name__ == '__main__':
     # TRAINING
     # ==========================================
     start_time = time.time()
+    updates = 0
     for step in range(args.epochs):
 
         total_loss = 0
         train_losses = 0
         start_epoch_time = time.time()
 
+        if args.frame_budget:
+            # reshuffle within duration buckets and repack the batches
+            train_sampler.shuffle(step)
+        elif args.distributed and args.balance:
+            # reshuffle within duration buckets and rebalance the steps
+            train_sampler.shuffle(step)
+            rank_ratios, step_ratio = train_sampler.imbalance()
+            print('[Epoch %d] rank %d load %.3f of mean, slowest rank per step %.3f of mean' %
+                  (step, args.rank, rank_ratios[args.rank], step_ratio))
+
         for i, (data) in enumerate(train_loader):
 
             if i == len(train_sampler):
                 break
 
-            inputs, targets, input_percentages, target_sizes, targets_one_hot, targets_list, labels_map = data
+            inputs, targets, input_sizes, target_sizes, targets_list = data
 
-            input_sizes = input_percentages.mul_(int(inputs.size(3))).int()
-
-            if inputs.shape[0] == 1:
-                break
-
-            inputs = inputs.to(device)
-            targets_list = targets_list.to(device)
+            inputs = inputs.to(device, non_blocking=True)
+            targets_list = targets_list.to(device, non_blocking=True)
+            if frontend is not None:
+                inputs, input_sizes = frontend(inputs.view(inputs.size(0), -1), input_sizes)
+            if args.spec_augment:
+                inputs = spec_augment(inputs, input_sizes, replace_with_zero=normalize)
 
             model.train()
             optimizer.zero_grad()
-            train_loss = model(inputs, targets_list, input_sizes, target_sizes)
-            # train_loss = model(inputs, targets_one_hot, input_sizes, target_sizes)
+            train_loss = model(inputs, targets_list, input_sizes, target_sizes, step=updates)
             train_loss.backward()
             optimizer.step()
+            updates += 1
             train_losses += float(train_loss)
 
             if i % 1000 == 0 and i > 0:
@@ -217,49 +358,50 @@ if __name__ == '__main__':
         eval_losses = 0
         total_cer = []
         total_wer = []
-
-        for i, (data) in enumerate(test_loader):
-
-            inputs, targets, input_percentages, target_sizes, targets_one_hot, targets_list, labels_map = data
-
-            input_sizes = input_percentages.mul_(int(inputs.size(3))).int()
-
-            if inputs.shape[0] == 1:
-                break
-
-            inputs = inputs.to(device)
-            targets_list = targets_list.to(device)
-
-            eval_loss = model(inputs, targets_list, input_sizes, target_sizes)
-            # eval_loss = model(inputs, targets_one_hot, input_sizes, target_sizes)
-            eval_losses += float(eval_loss)
-
-            inverse_map = dict((v, k) for k, v in labels_map.items())
-
-            if args.beam_search:
-                y, nll = model.beam_search(inputs, labels_map=labels_map)
-            else:
-                y = model.greedy_decode_batch(inputs)
-
-            # mapped_pred = [inverse_map[i] for i in y]
-            mapped_pred = eval_utils.convert_to_strings(inverse_map, y)
-
-            targets_list = targets_list.tolist()
-            # mapped_target = [inverse_map[j] for j in targets_list[0]]
-            mapped_target = eval_utils.convert_to_strings(inverse_map, targets_list)
-
-            # eval using metric WER, CER
-            for i in range(len(mapped_target)):
-                temp_mapped_pred = mapped_pred[i]
-                temp_mapped_target = mapped_target[i]
-                cer = eval_utils.cer(temp_mapped_pred, temp_mapped_target)
-                wer = eval_utils.wer(temp_mapped_pred, temp_mapped_target)
-                total_cer.append(cer)
-                total_wer.append(wer)
-
-                # print("===========inference & RAW =============")
-                # print(temp_mapped_pred)
-                # print(temp_mapped_target)
+        # the cached states are stale once the model is updated
+        cache = DecoderStateCache(args.state_cache) if args.beam_search and args.state_cache > 0 else None
+
+        # dropout off and batch norm statistics frozen, the decoder states are then deterministic
+        model.eval()
+        with torch.no_grad():
+            for i, (data) in enumerate(test_loader):
+
+                inputs, targets, input_sizes, target_sizes, targets_list = data
+
+                inputs = inputs.to(device, non_blocking=True)
+                targets_list = targets_list.to(device, non_blocking=True)
+                if frontend is not None:
+                    inputs, input_sizes = frontend(inputs.view(inputs.size(0), -1), input_sizes)
+
+                eval_loss = model(inputs, targets_list, input_sizes, target_sizes)
+                eval_losses += float(eval_loss)
+
+                if args.beam_search:
+                    y, nll = model.beam_search(inputs, input_sizes, beam=args.beam_size, schedule=args.beam_search,
+                                               cache=cache)
+                else:
+                    y = model.greedy_decode_batch(inputs, input_sizes, max_symbols=args.max_symbols)
+
+                # mapped_pred = [inverse_map[i] for i in y]
+                mapped_pred = eval_utils.convert_to_strings(inverse_map, y)
+
+                targets_list = [target[:size] for target, size in zip(targets_list.tolist(), target_sizes.tolist())]
+                # mapped_target = [inverse_map[j] for j in targets_list[0]]
+                mapped_target = eval_utils.convert_to_strings(inverse_map, targets_list)
+
+                # eval using metric WER, CER
+                for i in range(len(mapped_target)):
+                    temp_mapped_pred = mapped_pred[i]
+                    temp_mapped_target = mapped_target[i]
+                    cer = eval_utils.cer(temp_mapped_pred, temp_mapped_target)
+                    wer = eval_utils.wer(temp_mapped_pred, temp_mapped_target)
+                    total_cer.append(cer)
+                    total_wer.append(wer)
+
+                    # print("===========inference & RAW =============")
+                    # print(temp_mapped_pred)
+                    # print(temp_mapped_target)
+        model.train()
 
         train_losses = train_losses / len(train_loader)
         eval_losses = eval_losses / len(test_loader)
@@ -271,6 +413,10 @@ if __name__ == '__main__':
 
         print('[Epoch %d / Time %.3f ] loss %.2f, eval loss %.2f, CER %.2f, WER %.2f'
               %(step, epoch_time, train_losses, eval_losses, total_cer, total_wer))
+        if args.prefetch:
+            print('[Epoch %d] train loader: %s' % (step, train_loader.stats))
+        if cache is not None:
+            print('[Epoch %d] decoder state cache: %s' % (step, cache))
 
         # save model each 50 epochs
         if step % 50 == 0: